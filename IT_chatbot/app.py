@@ -1,10 +1,12 @@
 import streamlit as st
+import asyncio
 import os
 import sys
 import uuid
-from testing_pipeline import data_extractions, process_and_embed_chunks
-from helpers.DB import ingest_to_postgres
-from helpers.vector_db import insert_to_weaviate
+import threading
+from io import BytesIO
+from docling.datamodel.base_models import DocumentStream
+from testing_pipeline import stream_ingest
 
 try:
     from rag_generator import rag_answer_with_memory
@@ -14,6 +16,21 @@ except Exception as e:
 
 st.set_page_config(page_title="RAG Chunker Bot", layout="wide")
 
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """One event loop for the whole process, running on a background thread.
+    The LLM client's pooled connections belong to the loop they were opened on,
+    so every message must run on the same loop, not a fresh one per rerun."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
 st.title("🤖 RAG Document Processor & Chat")
 
 # --- Sidebar: File Upload ---
@@ -22,23 +39,14 @@ with st.sidebar:
     uploaded_file = st.file_uploader("Choose a PDF file", type="pdf")
     
     if uploaded_file:
-        # Save temp file for Docling to read
-        temp_path = f"temp_{uploaded_file.name}"
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
         if st.button("🚀 Process & Ingest"):
-            with st.spinner("Extracting chunks with Docling..."):
-                chunks = data_extractions(temp_path)
-                
-            with st.spinner("Embedding and Ingesting..."):
-                ingestion_data = process_and_embed_chunks(docling_chunks=chunks)
-                # Ingest into both DBs
-                ingest_to_postgres(ingestion_data["chunks"])
-                insert_to_weaviate(ingestion_data)
+            with st.spinner("Extracting, embedding and ingesting chunks..."):
+                # Hand the upload to Docling from memory, no temp file needed
+                source = DocumentStream(name=uploaded_file.name, stream=BytesIO(uploaded_file.getvalue()))
+                # Chunks are embedded and ingested into both DBs batch by batch
+                ingested = stream_ingest(source)
                 
-            st.success(f"Ingested {len(chunks)} chunks successfully!")
-            os.remove(temp_path)
+            st.success(f"Ingested {ingested} chunks successfully!")
 
 # --- Main Chat Interface ---
 st.subheader("Chat with your Data")
@@ -64,7 +72,7 @@ if prompt := st.chat_input("Ask something about the documents..."):
                 st.session_state["user_id"] = user_id
             with st.spinner("Generating answer..."):
                 try:
-                    response = rag_answer_with_memory(prompt, user_id)
+                    response = run_async(rag_answer_with_memory(prompt, user_id))
                 except Exception as e:
                     response = f"❌ Error generating response: {e}"
         else:
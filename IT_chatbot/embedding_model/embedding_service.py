@@ -3,13 +3,31 @@ Embedding Service API - Microservice for handling embeddings
 Separates embedding logic into its own service to be deployed independently
 """
 
-from fastapi import FastAPI, HTTPException
+import os
+
+# Split the cores between uvicorn workers; OpenMP/MKL read these once when torch is imported
+WORKERS = int(os.getenv("WORKERS", 1))
+THREADS_PER_WORKER = max(1, (os.cpu_count() or 1) // WORKERS)
+os.environ.setdefault("OMP_NUM_THREADS", str(THREADS_PER_WORKER))
+os.environ.setdefault("MKL_NUM_THREADS", str(THREADS_PER_WORKER))
+
+from fastapi import FastAPI, HTTPException, Request, Response
 from pydantic import BaseModel
 from typing import List, Dict, Any
 from sentence_transformers import SentenceTransformer
 import torch
+import numpy as np
+import ormsgpack
+import orjson
 from dotenv import load_dotenv
 import logging
+import hashlib
+import contextlib
+
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -23,17 +41,252 @@ app = FastAPI(title="Embedding Service API", version="1.0.0")
 
 # Initialize embedding model
 EMBEDDING_MODEL = "BAAI/bge-m3"
+# "onnx" / "openvino" use the INT8 models produced by the export scripts, "torch" the FP32 model
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+ONNX_MODEL_DIR = os.getenv("EMBEDDING_ONNX_DIR", "/models/bge-m3-onnx")
+ONNX_MODEL_FILE = "onnx/model_qint8_avx512_vnni.onnx"
+OPENVINO_MODEL_DIR = os.getenv("EMBEDDING_OPENVINO_DIR", "/models/bge-m3-openvino")
+OPENVINO_MODEL_FILE = "openvino/openvino_model_qint8_quantized.xml"
+# ONNX Runtime session tuning: fewer threads favour single /embed latency, more favour batches
+ORT_INTRA_OP_THREADS = int(os.getenv("EMBEDDING_ORT_THREADS", THREADS_PER_WORKER))
+ORT_PARALLEL_EXECUTION = os.getenv("EMBEDDING_ORT_PARALLEL", "false").lower() == "true"
+# Larger batches keep all GPU SMs busy, 64 suits CPU cache sizes
+ENCODE_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 128 if torch.cuda.is_available() else 64))
+# Torch backend only: compile the transformer (opt-in) and run it under BF16 autocast (AMX-BF16 CPUs)
+TORCH_COMPILE = os.getenv("EMBEDDING_TORCH_COMPILE", "false").lower() == "true"
+AUTOCAST_BF16 = os.getenv("EMBEDDING_AUTOCAST_BF16", "false").lower() == "true"
+# Content-hash -> float16 vector cache, empty path disables it
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/models/embedding-cache")
+# Longest input the warmup pass uses, the chunker caps chunks at 512 tokens
+WARMUP_SEQ_LENGTH = int(os.getenv("WARMUP_SEQ_LENGTH", 512))
 embedding_model = None
+embedding_cache = None
+
+def onnx_session_options():
+    """
+    Build ONNX Runtime session options with all graph optimizations enabled
+    
+    Returns:
+        onnxruntime.SessionOptions: Options for the ONNX backend session
+    """
+    import onnxruntime as ort
+    
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = ORT_INTRA_OP_THREADS
+    options.execution_mode = (
+        ort.ExecutionMode.ORT_PARALLEL if ORT_PARALLEL_EXECUTION else ort.ExecutionMode.ORT_SEQUENTIAL
+    )
+    return options
+
+def load_torch_model(device: str) -> SentenceTransformer:
+    """
+    Load the torch model, in BF16 with FlashAttention-2 on CUDA
+    Falls back to eager attention if FlashAttention-2 is not installed or supported
+    
+    Args:
+        device: Device to load the model on
+        
+    Returns:
+        SentenceTransformer: Loaded embedding model
+    """
+    if device != "cuda":
+        return SentenceTransformer(EMBEDDING_MODEL, device=device)
+    
+    try:
+        return SentenceTransformer(
+            EMBEDDING_MODEL,
+            device=device,
+            model_kwargs={"torch_dtype": torch.bfloat16, "attn_implementation": "flash_attention_2"}
+        )
+    except (ImportError, ValueError) as e:
+        logger.warning(f"FlashAttention-2 unavailable, using eager attention: {e}")
+        return SentenceTransformer(
+            EMBEDDING_MODEL,
+            device=device,
+            model_kwargs={"torch_dtype": torch.bfloat16, "attn_implementation": "eager"}
+        )
+
+def load_embedding_model(device: str) -> SentenceTransformer:
+    """
+    Load the embedding model for the configured backend
+    The INT8 exports are tuned for CPU, so CUDA always uses the BF16 torch model.
+    Falls back to the torch model if the exported model is not available
+    
+    Args:
+        device: Device to load the model on
+        
+    Returns:
+        SentenceTransformer: Loaded embedding model
+    """
+    if device == "cuda" or EMBEDDING_BACKEND not in ("onnx", "openvino"):
+        return load_torch_model(device)
+    
+    if EMBEDDING_BACKEND == "onnx":
+        model_dir, model_file = ONNX_MODEL_DIR, ONNX_MODEL_FILE
+    else:
+        model_dir, model_file = OPENVINO_MODEL_DIR, OPENVINO_MODEL_FILE
+
+    if not os.path.exists(os.path.join(model_dir, model_file)):
+        logger.warning(f"{EMBEDDING_BACKEND} model not found in '{model_dir}', falling back to torch backend")
+        return load_torch_model(device)
+
+    model_kwargs = {"file_name": model_file}
+    if EMBEDDING_BACKEND == "onnx":
+        model_kwargs["provider"] = "CPUExecutionProvider"
+        model_kwargs["session_options"] = onnx_session_options()
+
+    return SentenceTransformer(
+        model_dir,
+        device=device,
+        backend=EMBEDDING_BACKEND,
+        model_kwargs=model_kwargs
+    )
+
+def inference_context():
+    """Context for running the model: no autograd, plus BF16 autocast when enabled"""
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if AUTOCAST_BF16 and getattr(embedding_model, "backend", "torch") == "torch":
+        stack.enter_context(torch.autocast(embedding_model.device.type, dtype=torch.bfloat16))
+    return stack
+
+def optimize_torch_model(model: SentenceTransformer):
+    """
+    Tune a torch-backed model for inference
+    Compiles the transformer so pooling and normalization run on fused kernels
+    
+    Args:
+        model: Loaded embedding model
+    """
+    if getattr(model, "backend", "torch") != "torch":
+        return
+    torch.set_float32_matmul_precision("high")
+    if TORCH_COMPILE:
+        eager_model = model[0].auto_model
+        try:
+            model[0].auto_model = torch.compile(eager_model, mode="reduce-overhead", dynamic=True)
+            # Compilation is lazy, run one encode so a failure shows up here and not on every request
+            with torch.inference_mode():
+                model.encode(["warmup"], convert_to_numpy=True)
+        except Exception as e:
+            model[0].auto_model = eager_model
+            logger.warning(f"torch.compile failed, using eager model: {e}")
+
+def encode_texts(texts: List[str]):
+    """
+    Encode a list of texts in a single call
+    SentenceTransformer sorts the texts by length before splitting them into
+    mini-batches, so each batch is padded only to similar lengths
+    Repeated texts (page headers, footers, disclaimers) are encoded once
+    
+    Args:
+        texts: Texts to embed
+        
+    Returns:
+        np.ndarray: Normalized embeddings in the same order as the input
+    """
+    unique_index = {}
+    positions = [unique_index.setdefault(text, len(unique_index)) for text in texts]
+    with inference_context():
+        vectors = embedding_model.encode(
+            list(unique_index),
+            batch_size=ENCODE_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True
+        )
+    if len(unique_index) == len(texts):
+        return vectors
+    return vectors[positions]
+
+def cache_key(text: str) -> bytes:
+    """Content hash of a text, scoped to the model and backend that embed it"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{EMBEDDING_MODEL}:{EMBEDDING_BACKEND}:".encode())
+    digest.update(text.encode())
+    return digest.digest()
+
+def encode_texts_cached(texts: List[str]):
+    """
+    Encode texts, reusing cached vectors for texts that were already embedded
+    Only cache misses are sent to the model; new vectors are written back
+    
+    Args:
+        texts: Texts to embed
+        
+    Returns:
+        np.ndarray: Normalized embeddings in the same order as the input
+    """
+    if embedding_cache is None:
+        return encode_texts(texts)
+    
+    keys = [cache_key(text) for text in texts]
+    vectors = [None] * len(texts)
+    with embedding_cache.begin(buffers=True) as txn:
+        for i, key in enumerate(keys):
+            cached = txn.get(key)
+            if cached is not None:
+                vectors[i] = np.frombuffer(cached, dtype=np.float16).astype(np.float32)
+    
+    misses = [i for i, vector in enumerate(vectors) if vector is None]
+    if misses:
+        new_vectors = encode_texts([texts[i] for i in misses])
+        with embedding_cache.begin(write=True) as txn:
+            for i, vector in zip(misses, new_vectors):
+                txn.put(keys[i], vector.astype(np.float16).tobytes())
+                vectors[i] = vector
+    
+    logger.info(f"Embedding cache: {len(texts) - len(misses)} hits, {len(misses)} misses")
+    return np.vstack(vectors)
+
+def open_embedding_cache():
+    """Open the LMDB embedding cache, or return None if it is unavailable"""
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    if lmdb is None:
+        logger.warning("lmdb is not installed, embedding cache disabled")
+        return None
+    try:
+        return lmdb.open(EMBEDDING_CACHE_PATH, map_size=2**34, writemap=True)
+    except Exception as e:
+        logger.warning(f"Could not open embedding cache at '{EMBEDDING_CACHE_PATH}': {e}")
+        return None
+
+def warmup_model(model: SentenceTransformer):
+    """
+    Run dummy passes so the first request does not pay for lazy initialization
+    (CUDA context, torch.compile, thread pools), plus one pass at the longest
+    expected input (WARMUP_SEQ_LENGTH) so buffers for chunk-sized inputs are allocated
+    
+    Args:
+        model: Loaded embedding model
+    """
+    max_seq_length = model.max_seq_length
+    try:
+        with inference_context():
+            model.encode(["warmup"] * 8, batch_size=8, normalize_embeddings=True)
+            # Truncated to exactly WARMUP_SEQ_LENGTH tokens, not the model's full context
+            model.max_seq_length = min(WARMUP_SEQ_LENGTH, max_seq_length)
+            model.encode(["warmup " * WARMUP_SEQ_LENGTH], normalize_embeddings=True)
+        logger.info("Embedding model warmed up")
+    except Exception as e:
+        logger.warning(f"Model warmup failed, first request may be slow: {e}")
+    finally:
+        model.max_seq_length = max_seq_length
 
 @app.on_event("startup")
 async def startup_event():
     """Load embedding model on startup"""
-    global embedding_model
+    global embedding_model, embedding_cache
     try:
-        logger.info(f"Loading embedding model: '{EMBEDDING_MODEL}'...")
+        logger.info(f"Loading embedding model: '{EMBEDDING_MODEL}' (backend: {EMBEDDING_BACKEND})...")
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        embedding_model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+        embedding_model = load_embedding_model(device)
+        torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+        optimize_torch_model(embedding_model)
         logger.info(f"Embedding model loaded successfully on device: {device}")
+        embedding_cache = open_embedding_cache()
+        warmup_model(embedding_model)
     except Exception as e:
         logger.error(f"ERROR: Could not load SentenceTransformer model: {e}")
         raise RuntimeError(f"Failed to load embedding model: {e}")
@@ -46,27 +299,46 @@ class EmbedRequest(BaseModel):
     """Request model for embedding a single text"""
     text: str
 
-class BatchEmbedRequest(BaseModel):
-    """Request model for batch embedding texts"""
-    texts: List[str]
-
 class EmbedResponse(BaseModel):
     """Response model for single embedding"""
     text: str
     embedding: List[float]
 
 class BatchEmbedResponse(BaseModel):
-    """Response model for batch embeddings"""
-    embeddings: List[Dict[str, Any]]
-
-class EmbedChunksRequest(BaseModel):
-    """Request model for embedding processed chunks"""
-    chunks: List[Dict[str, Any]]
+    """Response model for batch embeddings, row i of 'embeddings' belongs to texts[i]"""
+    texts: List[str]
+    embeddings: List[List[float]]
 
 class EmbedChunksResponse(BaseModel):
     """Response model for chunk embeddings"""
     chunks: List[Dict[str, Any]]
 
+async def read_json_list(request: Request, field: str, item_type: type) -> list:
+    """
+    Parse a JSON body with orjson and return its list field
+    Used instead of pydantic models on the batch endpoints, which would copy
+    and validate every item of large payloads
+    
+    Args:
+        request: Raw request with a JSON body {field: [...]}
+        field: Name of the list field
+        item_type: Expected type of every item
+        
+    Returns:
+        list: The non-empty list of items
+    """
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}")
+    
+    items = payload.get(field) if isinstance(payload, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, item_type) for item in items):
+        raise HTTPException(status_code=422, detail=f"'{field}' must be a list of {item_type.__name__}")
+    if not items:
+        raise HTTPException(status_code=400, detail=f"No {field} provided")
+    return items
+
 # ========================
 # Endpoints
 # ========================
@@ -85,58 +357,95 @@ async def embed_single(request: EmbedRequest):
         request: EmbedRequest with text to embed
         
     Returns:
-        EmbedResponse with text and embedding vector
+        EmbedResponse with text and embedding vector, serialized in one orjson call
     """
     if embedding_model is None:
         raise HTTPException(status_code=503, detail="Embedding model not loaded")
     
     try:
-        vector = embedding_model.encode(request.text, normalize_embeddings=True).tolist()
-        return EmbedResponse(text=request.text, embedding=vector)
+        with inference_context():
+            vector = embedding_model.encode(request.text, normalize_embeddings=True, convert_to_numpy=True)
+        # orjson writes the numpy row directly instead of boxing every component with .tolist()
+        return Response(
+            content=orjson.dumps(
+                {"text": request.text, "embedding": vector},
+                option=orjson.OPT_SERIALIZE_NUMPY
+            ),
+            media_type="application/json"
+        )
     except Exception as e:
         logger.error(f"Error embedding text: {e}")
         raise HTTPException(status_code=500, detail=f"Embedding failed: {str(e)}")
 
 @app.post("/embed-batch", response_model=BatchEmbedResponse)
-async def embed_batch(request: BatchEmbedRequest):
+async def embed_batch(request: Request):
     """
     Embed multiple texts in batch
     
     Args:
-        request: BatchEmbedRequest with list of texts to embed
+        request: Raw request with a JSON body {"texts": [...]}
         
     Returns:
-        BatchEmbedResponse with list of embeddings
+        BatchEmbedResponse with list of embeddings, serialized in one orjson call
     """
     if embedding_model is None:
         raise HTTPException(status_code=503, detail="Embedding model not loaded")
     
-    if not request.texts:
-        raise HTTPException(status_code=400, detail="No texts provided")
+    texts = await read_json_list(request, "texts", str)
     
     try:
-        embeddings = []
-        vectors = embedding_model.encode(request.texts, normalize_embeddings=True)
-        
-        for text, vector in zip(request.texts, vectors):
-            embeddings.append({
-                "text": text,
-                "embedding": vector.tolist()
-            })
-        
-        return BatchEmbedResponse(embeddings=embeddings)
+        vectors = encode_texts(texts)
+        return Response(
+            content=orjson.dumps(
+                {"texts": texts, "embeddings": vectors},
+                option=orjson.OPT_SERIALIZE_NUMPY
+            ),
+            media_type="application/json"
+        )
     except Exception as e:
         logger.error(f"Error embedding batch: {e}")
         raise HTTPException(status_code=500, detail=f"Batch embedding failed: {str(e)}")
 
+@app.post("/embed-batch-binary")
+async def embed_batch_binary(request: Request):
+    """
+    Embed multiple texts in batch and return the raw float16 matrix
+    Avoids serializing every vector component as a JSON float
+    
+    Args:
+        request: Raw request with a JSON body {"texts": [...]}
+        
+    Returns:
+        Response with the row-major float16 matrix as bytes, its shape in the
+        'x-shape' header and its dtype in the 'x-dtype' header
+    """
+    if embedding_model is None:
+        raise HTTPException(status_code=503, detail="Embedding model not loaded")
+    
+    texts = await read_json_list(request, "texts", str)
+    
+    try:
+        vectors = encode_texts(texts).astype(np.float16)
+        return Response(
+            content=vectors.tobytes(),
+            media_type="application/octet-stream",
+            headers={
+                "x-shape": f"{vectors.shape[0]},{vectors.shape[1]}",
+                "x-dtype": "float16"
+            }
+        )
+    except Exception as e:
+        logger.error(f"Error embedding binary batch: {e}")
+        raise HTTPException(status_code=500, detail=f"Batch embedding failed: {str(e)}")
+
 @app.post("/embed-chunks", response_model=EmbedChunksResponse)
-async def embed_chunks(request: EmbedChunksRequest):
+async def embed_chunks(request: Request):
     """
     Embed chunks data structure
     Adds 'vector' field to each chunk with its embedding
     
     Args:
-        request: EmbedChunksRequest with list of chunk dictionaries
+        request: Raw request with a JSON body {"chunks": [...]}
         
     Returns:
         EmbedChunksResponse with chunks containing embeddings
@@ -144,22 +453,68 @@ async def embed_chunks(request: EmbedChunksRequest):
     if embedding_model is None:
         raise HTTPException(status_code=503, detail="Embedding model not loaded")
     
-    if not request.chunks:
-        raise HTTPException(status_code=400, detail="No chunks provided")
+    chunks = await read_json_list(request, "chunks", dict)
     
     try:
         # Extract texts from chunks
-        texts_to_embed = [chunk.get("text", "") for chunk in request.chunks]
+        texts_to_embed = [chunk.get("text", "") for chunk in chunks]
         
         # Generate embeddings
-        vectors = embedding_model.encode(texts_to_embed, normalize_embeddings=True)
+        vectors = encode_texts_cached(texts_to_embed)
+        
+        # Add embeddings to chunks (numpy rows, serialized by orjson without .tolist())
+        for i, chunk in enumerate(chunks):
+            chunk["vector"] = vectors[i]
+        
+        logger.info(f"Successfully embedded {len(chunks)} chunks")
+        return Response(
+            content=orjson.dumps({"chunks": chunks}, option=orjson.OPT_SERIALIZE_NUMPY),
+            media_type="application/json"
+        )
+    except Exception as e:
+        logger.error(f"Error embedding chunks: {e}")
+        raise HTTPException(status_code=500, detail=f"Chunk embedding failed: {str(e)}")
+
+@app.post("/embed-chunks-msgpack")
+async def embed_chunks_msgpack(request: Request):
+    """
+    Embed chunks data structure sent as MessagePack
+    Same contract as /embed-chunks, but both bodies are MessagePack and the
+    vectors are packed straight from the numpy matrix
+    
+    Args:
+        request: Raw request with a MessagePack body {"chunks": [...]}
         
-        # Add embeddings to chunks
-        for i, chunk in enumerate(request.chunks):
-            chunk["vector"] = vectors[i].tolist()
+    Returns:
+        Response with a MessagePack body {"chunks": [...]} containing embeddings
+    """
+    if embedding_model is None:
+        raise HTTPException(status_code=503, detail="Embedding model not loaded")
+    
+    try:
+        payload = ormsgpack.unpackb(await request.body())
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid MessagePack body: {str(e)}")
+    
+    chunks = payload.get("chunks") if isinstance(payload, dict) else None
+    # Malformed payloads are the client's error, not a failed embedding
+    if not isinstance(chunks, list) or not all(
+        isinstance(chunk, dict) and isinstance(chunk.get("text", ""), str) for chunk in chunks
+    ):
+        raise HTTPException(status_code=400, detail="'chunks' must be a list of objects with a string 'text'")
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No chunks provided")
+    
+    try:
+        vectors = encode_texts_cached([chunk.get("text", "") for chunk in chunks])
+        for chunk, vector in zip(chunks, vectors):
+            chunk["vector"] = vector
         
-        logger.info(f"Successfully embedded {len(request.chunks)} chunks")
-        return EmbedChunksResponse(chunks=request.chunks)
+        logger.info(f"Successfully embedded {len(chunks)} chunks")
+        return Response(
+            content=ormsgpack.packb({"chunks": chunks}, option=ormsgpack.OPT_SERIALIZE_NUMPY),
+            media_type="application/msgpack"
+        )
     except Exception as e:
         logger.error(f"Error embedding chunks: {e}")
         raise HTTPException(status_code=500, detail=f"Chunk embedding failed: {str(e)}")
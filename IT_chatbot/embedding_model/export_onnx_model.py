@@ -0,0 +1,48 @@
+"""
+Build-time export of the embedding model to ONNX + INT8
+Exports BAAI/bge-m3 once and applies AVX-512 VNNI dynamic quantization so the
+embedding service can load it with the SentenceTransformer ONNX backend
+"""
+
+import os
+import logging
+
+from sentence_transformers import SentenceTransformer
+from optimum.onnxruntime import ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "BAAI/bge-m3"
+ONNX_MODEL_DIR = os.getenv("EMBEDDING_ONNX_DIR", "/models/bge-m3-onnx")
+QUANTIZED_SUFFIX = "qint8_avx512_vnni"
+
+
+def export_onnx_model(output_dir: str = ONNX_MODEL_DIR):
+    """
+    Export the model to ONNX and quantize it to INT8
+
+    The SentenceTransformer wrapper is saved alongside the ONNX graph so the
+    pooling and normalization modules are kept when the service reloads it.
+
+    Args:
+        output_dir: Directory where the exported model is written
+    """
+    logger.info(f"Exporting '{EMBEDDING_MODEL}' to ONNX in '{output_dir}'...")
+    model = SentenceTransformer(EMBEDDING_MODEL, backend="onnx", device="cpu")
+    model.save_pretrained(output_dir)
+
+    onnx_dir = os.path.join(output_dir, "onnx")
+    logger.info("Applying INT8 dynamic quantization (avx512_vnni)...")
+    quantizer = ORTQuantizer.from_pretrained(onnx_dir, file_name="model.onnx")
+    quantizer.quantize(
+        save_dir=onnx_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False),
+        file_suffix=QUANTIZED_SUFFIX,
+    )
+    logger.info(f"Quantized model saved to '{onnx_dir}/model_{QUANTIZED_SUFFIX}.onnx'")
+
+
+if __name__ == "__main__":
+    export_onnx_model()
@@ -0,0 +1,86 @@
+"""
+One-shot export of the embedding model to OpenVINO + static INT8
+Calibrates the quantization on chunk texts sampled from Postgres so the
+quantization ranges reflect the real input distribution
+"""
+
+import os
+import orjson
+import logging
+import tempfile
+
+import psycopg2
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer, export_static_quantized_openvino_model
+from optimum.intel import OVQuantizationConfig
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+EMBEDDING_MODEL = "BAAI/bge-m3"
+OPENVINO_MODEL_DIR = os.getenv("EMBEDDING_OPENVINO_DIR", "/models/bge-m3-openvino")
+CALIBRATION_SAMPLES = 100
+
+
+def sample_chunk_texts(limit: int = CALIBRATION_SAMPLES) -> list:
+    """
+    Sample chunk texts from the Postgres 'chunks' table
+
+    Args:
+        limit: Number of texts to sample
+
+    Returns:
+        list: Sampled chunk texts
+    """
+    conn = psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST", "db"),
+        database=os.getenv("POSTGRES_DB"),
+        user=os.getenv("POSTGRES_USER"),
+        password=os.getenv("POSTGRES_PASSWORD"),
+        port=os.getenv("POSTGRES_PORT")
+    )
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT text FROM chunks ORDER BY random() LIMIT %s", (limit,))
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def export_openvino_model(output_dir: str = OPENVINO_MODEL_DIR):
+    """
+    Export the model to OpenVINO and apply static INT8 quantization
+
+    Args:
+        output_dir: Directory where the exported model is written
+    """
+    texts = sample_chunk_texts()
+    if not texts:
+        raise RuntimeError("No chunks found in Postgres to calibrate on")
+    logger.info(f"Sampled {len(texts)} chunk texts for calibration")
+
+    model = SentenceTransformer(EMBEDDING_MODEL, backend="openvino", device="cpu")
+    model.save_pretrained(output_dir)
+
+    with tempfile.TemporaryDirectory() as calibration_dir:
+        # The exporter loads calibration data through `datasets.load_dataset`
+        with open(os.path.join(calibration_dir, "train.jsonl"), "wb") as f:
+            for text in texts:
+                # orjson emits UTF-8 bytes, written as-is
+                f.write(orjson.dumps({"text": text}) + b"\n")
+
+        export_static_quantized_openvino_model(
+            model,
+            OVQuantizationConfig(num_samples=len(texts)),
+            output_dir,
+            dataset_name=calibration_dir,
+            dataset_split="train",
+            column_name="text",
+        )
+    logger.info(f"Quantized model saved to '{output_dir}/openvino'")
+
+
+if __name__ == "__main__":
+    export_openvino_model()
@@ -1,10 +1,12 @@
-import json # <-- ADD THIS IMPORT
 from typing import List, Dict, Any
 from dotenv import load_dotenv
 import os
 import psycopg2
 from psycopg2 import Error
+from psycopg2.pool import ThreadedConnectionPool
+from io import StringIO
 import time
+import atexit
 
 
 load_dotenv()
@@ -41,7 +43,12 @@ def get_postgres_connection():
 # --- Run Setup ---
 
 MAX_RETRIES = 10
-RETRY_INTERVAL = 3  # seconds
+RETRY_INTERVAL = 0.5  # seconds, doubled after every failed attempt
+MAX_RETRY_INTERVAL = 8
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff, a restarting server is picked up quickly without hammering a slow one."""
+    return min(RETRY_INTERVAL * 2 ** attempt, MAX_RETRY_INTERVAL)
 
 def wait_for_postgres():
     for attempt in range(MAX_RETRIES):
@@ -59,10 +66,115 @@ def wait_for_postgres():
             return True
         except Exception as e:
             print(f"Connection failed: {e}")
-            time.sleep(RETRY_INTERVAL)
+            time.sleep(retry_delay(attempt))
     print("PostgreSQL not available after multiple attempts.")
     return False
 
+class _ChunkConnection(psycopg2.extensions.connection):
+    """Pooled connection that remembers whether its session has the chunk staging table."""
+    chunk_stage_ready = False
+
+# Streamed ingestion calls ingest_to_postgres once per batch, so connections are reused
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 4
+_pool = None
+
+def get_postgres_pool():
+    """Returns the process-wide connection pool, creating it once PostgreSQL is reachable."""
+    global _pool
+    if _pool is None:
+        if not wait_for_postgres():
+            return None
+        _pool = ThreadedConnectionPool(
+            POOL_MIN_CONNECTIONS,
+            POOL_MAX_CONNECTIONS,
+            host=DB_HOST,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            port=DB_PORT,
+            connection_factory=_ChunkConnection
+        )
+        atexit.register(_pool.closeall)
+    return _pool
+
+def release_connection(pool, conn):
+    """Returns a connection to the pool, closing it instead if its session broke."""
+    pool.putconn(conn, close=bool(conn.closed))
+
+CHUNK_COLUMNS = (
+    "chunk_id, doc_hash, chunk_index, filename, "
+    "page_numbers, title, text, content_types, bounding_boxes"
+)
+
+def _copy_field(value) -> str:
+    """Encode one value for COPY's text format (NULL as \\N, separators escaped)."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+def _float_array(values) -> str:
+    """Postgres array literal for a float8[] column."""
+    return "{" + ",".join(map(repr, values)) + "}"
+
+def _int_array(values) -> str:
+    """Postgres array literal for an integer[] column."""
+    return "{" + ",".join(map(str, values)) + "}"
+
+def _text_array(values) -> str:
+    """Postgres array literal for a text[] column, every element quoted."""
+    return "{" + ",".join(
+        '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values
+    ) + "}"
+
+# The staging table lives as long as the pooled session and is emptied on every commit,
+# so batches neither create nor drop catalog entries, and the merge is planned once per session
+_SETUP_CHUNK_STAGE_SQL = "CREATE TEMP TABLE IF NOT EXISTS chunks_stage (LIKE chunks INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+_PREPARE_MERGE_SQL = f"""
+    PREPARE merge_chunks_stage AS
+    INSERT INTO chunks ({CHUNK_COLUMNS})
+    SELECT {CHUNK_COLUMNS} FROM chunks_stage
+    ON CONFLICT (chunk_id) DO NOTHING;
+"""
+
+def _prepare_chunk_stage(cursor):
+    """Creates the session's staging table and merge statement on first use of a connection."""
+    conn = cursor.connection
+    if conn.chunk_stage_ready:
+        return
+    cursor.execute(_SETUP_CHUNK_STAGE_SQL)
+    # Committed on its own so a rolled back batch cannot take the table with it
+    conn.commit()
+    cursor.execute(_PREPARE_MERGE_SQL)
+    conn.chunk_stage_ready = True
+
+def _bulk_copy_chunks(cursor, rows: List[tuple]) -> int:
+    """
+    Streams rows into 'chunks' with COPY, skipping chunk_ids that already exist.
+    COPY cannot handle conflicts itself, so the rows go through a temporary staging
+    table that is emptied when the transaction commits.
+    Must run at the start of a transaction on a pooled connection.
+
+    Returns:
+        int: number of rows actually inserted
+    """
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    _prepare_chunk_stage(cursor)
+    cursor.copy_expert(f"COPY chunks_stage ({CHUNK_COLUMNS}) FROM STDIN", buffer)
+    cursor.execute("EXECUTE merge_chunks_stage;")
+    return cursor.rowcount
+
 # --- INGESTION (REPLACED) ---
 def ingest_to_postgres(data: List[Dict[str, Any]]):
     """
@@ -71,8 +183,9 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
     based on the 'chunk_id' primary key.
     """
     
-    # 1. Wait for the database to be ready
-    if not wait_for_postgres():
+    # 1. Wait for the database to be ready (only until the pool exists)
+    pool = get_postgres_pool()
+    if not pool:
         print("Exiting due to failed PostgreSQL connection.")
         return
 
@@ -80,13 +193,10 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
     cursor = None
     
     try:
-        # 2. Use your helper function to get the connection
-        # (This already sets autocommit=False)
-        conn, cursor = get_postgres_connection()
-        
-        if not conn or not cursor:
-            # get_postgres_connection already printed the error
-            return
+        # 2. Borrow a pooled connection, transactions are committed explicitly
+        conn = pool.getconn()
+        conn.autocommit = False
+        cursor = conn.cursor()
 
         # 3. Prepare the data for insertion
         insert_data = [
@@ -95,11 +205,11 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
                 d["doc_hash"],
                 d["chunk_index"],
                 d["filename"],
-                json.dumps(d["page_numbers"]) if d["page_numbers"] else None,
+                _int_array(d["page_numbers"]) if d["page_numbers"] else None,
                 d["title"],
                 d["text"],
-                json.dumps(d["content_types"]) if d["content_types"] else None,
-                json.dumps(d["bounding_boxes"]) if d["bounding_boxes"] else None,
+                _text_array(d["content_types"]) if d["content_types"] else None,
+                _float_array(d["bounding_boxes"]) if d["bounding_boxes"] else None,
             )
             for d in data
         ]
@@ -111,20 +221,13 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
         # 4. Execute the batch insert as a single transaction
         print(f"Attempting to ingest {len(insert_data)} chunks into PostgreSQL...")
         
-        cursor.executemany("""
-        INSERT INTO chunks (
-            chunk_id, doc_hash, chunk_index, filename, 
-            page_numbers, title, text, content_types, bounding_boxes
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (chunk_id) DO NOTHING;
-        """, insert_data)
+        inserted = _bulk_copy_chunks(cursor, insert_data)
         
         # 5. Commit the entire transaction
         conn.commit()
         
-        # cursor.rowcount shows how many rows were *actually* inserted
-        print(f"PostgreSQL batch insert successful. {cursor.rowcount} new rows inserted.")
+        # Conflicting chunk_ids are skipped, so this counts only new rows
+        print(f"PostgreSQL batch insert successful. {inserted} new rows inserted.")
 
     except Error as e:
         print(f"❌ ERROR: PostgreSQL transaction failed: {e}")
@@ -132,9 +235,8 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
         if conn:
             conn.rollback()
     finally:
-        # 7. Always close connections
+        # 7. Always return the connection to the pool
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
-        print("PostgreSQL connection closed.")
\ No newline at end of file
+            release_connection(pool, conn)
\ No newline at end of file
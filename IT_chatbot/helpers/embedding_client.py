@@ -3,150 +3,412 @@ Embedding Service Client
 Module for communicating with the Embedding Service API
 """
 
-import requests
+import asyncio
+import httpx
 import os
+import threading
+import time
+import numpy as np
+import ormsgpack
+import orjson
 from typing import List, Dict, Any
 import logging
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TIMEOUT = 300  # 5 minutes timeout for embedding operations
+POOL_LIMITS = httpx.Limits(max_keepalive_connections=16)
+MSGPACK_HEADERS = {"Content-Type": "application/msgpack"}
+HEALTH_CACHE_SECONDS = 30  # A successful health probe is trusted for this long
+BATCH_WINDOW_SECONDS = 0.005  # How long single embeds wait for others to share a batch
+MAX_BATCH_SIZE = 32
+CHUNKS_PER_REQUEST = 64  # Sub-batch size when a document's chunks are embedded concurrently
+MAX_CONCURRENT_REQUESTS = 8
+
+
+def _decode_binary_batch(response: httpx.Response) -> np.ndarray:
+    """Decode the raw matrix returned by the /embed-batch-binary route."""
+    rows, dim = (int(n) for n in response.headers["x-shape"].split(","))
+    dtype = np.dtype(response.headers.get("x-dtype", "float16"))
+    return np.frombuffer(response.content, dtype=dtype).reshape(rows, dim)
+
+
+def _decode_json_batch(response: httpx.Response) -> np.ndarray:
+    """Decode the JSON body returned by the /embed-batch route."""
+    return np.asarray(orjson.loads(response.content)["embeddings"], dtype=np.float32)
+
+
+class _Batcher:
+    """
+    Coalesces concurrent single-text embeds into one /embed-batch request
+    Runs its own event loop in a daemon thread so callers from any thread
+    (e.g. separate Streamlit sessions) land in the same batch
+    """
+
+    def __init__(self, base_url: str, timeout: float):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="embedding-batcher", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(base_url, timeout), self._loop).result()
+
+    async def _start(self, base_url: str, timeout: float):
+        """Create the queue, session and drain task inside the batcher loop"""
+        self._queue = asyncio.Queue()
+        self._session = httpx.AsyncClient(base_url=base_url, http2=True, timeout=timeout, limits=POOL_LIMITS)
+        self._task = asyncio.create_task(self._run())
+        # The loop only holds weak references to tasks, so in-flight flushes are kept here
+        self._flushes = set()
+
+    def submit(self, text: str):
+        """Queue a text from any thread, returning a concurrent.futures.Future of its vector"""
+        return asyncio.run_coroutine_threadsafe(self._submit(text), self._loop)
+
+    async def _submit(self, text: str) -> List[float]:
+        future = self._loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        """Drain the queue every BATCH_WINDOW_SECONDS or once MAX_BATCH_SIZE texts are waiting"""
+        while True:
+            items = [await self._queue.get()]
+            deadline = self._loop.time() + BATCH_WINDOW_SECONDS
+            while len(items) < MAX_BATCH_SIZE:
+                remaining = deadline - self._loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next window fills while this batch is in flight
+            flush = asyncio.create_task(self._flush(items))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, items: list):
+        """Embed one gathered batch and resolve each caller's future"""
+        try:
+            response = await self._session.post("/embed-batch", json={"texts": [text for text, _ in items]})
+            response.raise_for_status()
+            vectors = _decode_json_batch(response)
+        except Exception as e:
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.debug(f"Embedded {len(items)} coalesced queries in one batch")
+        for (_, future), vector in zip(items, vectors):
+            if not future.done():
+                future.set_result(vector.tolist())
+
+    async def _aclose(self):
+        self._task.cancel()
+        # Let batches already sent resolve their callers before the session goes away
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self._session.aclose()
+
+    def close(self):
+        """Stop the drain task, close the session and the event loop thread"""
+        asyncio.run_coroutine_threadsafe(self._aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
 class EmbeddingServiceClient:
     """Client for interacting with the Embedding Service API"""
-    
+
     def __init__(self, base_url: str = None):
         """
         Initialize the embedding service client
-        
+        Keeps a pooled HTTP/2 session so calls reuse open connections
+
         Args:
             base_url: Base URL of the embedding service.
                      Defaults to env var EMBEDDING_SERVICE_URL or http://localhost:8001
         """
         self.base_url = base_url or os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8001")
-        self.timeout = 300  # 5 minutes timeout for embedding operations
-        
+        self.timeout = DEFAULT_TIMEOUT
+        self.binary_batch = True  # Cleared if the service has no /embed-batch-binary route
+        self.msgpack_chunks = True  # Cleared if the service has no /embed-chunks-msgpack route
+        self._last_ok_ts = float("-inf")
+        self._model_info = None
+        self._batcher = None  # Started on the first single-text embed
+        self._batcher_lock = threading.Lock()
+        self._session = httpx.Client(
+            base_url=self.base_url,
+            http2=True,
+            timeout=self.timeout,
+            limits=POOL_LIMITS
+        )
+
+    def close(self):
+        """Close the pooled HTTP session and the query batcher"""
+        self._session.close()
+        if self._batcher is not None:
+            self._batcher.close()
+            self._batcher = None
+
+    def _get_batcher(self) -> _Batcher:
+        """Start the query batcher once, even if several threads embed at the same time"""
+        with self._batcher_lock:
+            if self._batcher is None:
+                self._batcher = _Batcher(self.base_url, self.timeout)
+            return self._batcher
+
     def health_check(self) -> bool:
         """
         Check if the embedding service is healthy
-        
+        A successful probe is reused for HEALTH_CACHE_SECONDS; failures are never cached
+
         Returns:
             bool: True if service is healthy, False otherwise
         """
+        if time.monotonic() - self._last_ok_ts < HEALTH_CACHE_SECONDS:
+            return True
         try:
-            response = requests.get(f"{self.base_url}/health", timeout=5)
-            return response.status_code == 200
+            response = self._session.get("/health", timeout=5)
+            if response.status_code != 200:
+                return False
+            self._last_ok_ts = time.monotonic()
+            return True
         except Exception as e:
             logger.error(f"Health check failed: {e}")
             return False
-    
+
     def embed_single(self, text: str) -> List[float]:
         """
         Embed a single text string
-        
+        Concurrent calls are coalesced into one batch request (see _Batcher)
+
         Args:
             text: Text to embed
-            
+
         Returns:
             List[float]: Embedding vector
-            
+
         Raises:
             Exception: If embedding fails
         """
         try:
-            response = requests.post(
-                f"{self.base_url}/embed",
-                json={"text": text},
-                timeout=self.timeout
-            )
-            response.raise_for_status()
-            return response.json()["embedding"]
+            return self._get_batcher().submit(text).result(timeout=self.timeout)
+        except Exception as e:
+            logger.error(f"Error embedding single text: {e}")
+            raise
+
+    async def embed_single_async(self, text: str) -> List[float]:
+        """Embed a single text from async code (see embed_single)"""
+        try:
+            return await asyncio.wrap_future(self._get_batcher().submit(text))
         except Exception as e:
             logger.error(f"Error embedding single text: {e}")
             raise
-    
-    def embed_batch(self, texts: List[str]) -> List[List[float]]:
+
+    def embed_batch(self, texts: List[str]) -> np.ndarray:
         """
         Embed multiple texts in batch
-        
+        Uses the binary float16 route when the service provides it
+
         Args:
             texts: List of texts to embed
-            
+
         Returns:
-            List[List[float]]: List of embedding vectors
-            
+            np.ndarray: Embedding matrix of shape (len(texts), dim)
+
         Raises:
             Exception: If embedding fails
         """
         try:
-            response = requests.post(
-                f"{self.base_url}/embed-batch",
-                json={"texts": texts},
-                timeout=self.timeout
-            )
+            if self.binary_batch:
+                response = self._session.post("/embed-batch-binary", json={"texts": texts})
+                if response.status_code != 404:
+                    response.raise_for_status()
+                    return _decode_binary_batch(response)
+                logger.info("Binary batch route not available, using JSON route")
+                self.binary_batch = False
+
+            response = self._session.post("/embed-batch", json={"texts": texts})
             response.raise_for_status()
-            embeddings = response.json()["embeddings"]
-            return [item["embedding"] for item in embeddings]
+            return _decode_json_batch(response)
         except Exception as e:
             logger.error(f"Error embedding batch: {e}")
             raise
-    
+
     def embed_chunks(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
         Embed chunks data structure
         Adds 'vector' field to each chunk
-        
+        Sends MessagePack when the service provides the msgpack route
+
         Args:
             chunks: List of chunk dictionaries with 'text' field
-            
+
         Returns:
             List[Dict[str, Any]]: Chunks with added 'vector' field
-            
+
         Raises:
             Exception: If embedding fails
         """
         try:
-            response = requests.post(
-                f"{self.base_url}/embed-chunks",
-                json={"chunks": chunks},
-                timeout=self.timeout
-            )
+            if self.msgpack_chunks:
+                response = self._session.post(
+                    "/embed-chunks-msgpack",
+                    content=ormsgpack.packb({"chunks": chunks}, option=ormsgpack.OPT_SERIALIZE_NUMPY),
+                    headers=MSGPACK_HEADERS
+                )
+                if response.status_code != 404:
+                    response.raise_for_status()
+                    return ormsgpack.unpackb(response.content)["chunks"]
+                logger.info("MessagePack chunks route not available, using JSON route")
+                self.msgpack_chunks = False
+
+            response = self._session.post("/embed-chunks", json={"chunks": chunks})
             response.raise_for_status()
-            return response.json()["chunks"]
+            return orjson.loads(response.content)["chunks"]
         except Exception as e:
             logger.error(f"Error embedding chunks: {e}")
             raise
-    
+
     def get_model_info(self) -> Dict[str, Any]:
         """
         Get information about the loaded embedding model
-        
+        Fetched once per client, the model does not change while the service runs
+
         Returns:
             Dict[str, Any]: Model information including dimensions and device
-            
+
         Raises:
             Exception: If request fails
         """
+        if self._model_info is not None:
+            return self._model_info
         try:
-            response = requests.get(
-                f"{self.base_url}/model-info",
-                timeout=10
-            )
+            response = self._session.get("/model-info", timeout=10)
             response.raise_for_status()
-            return response.json()
+            self._model_info = response.json()
+            return self._model_info
         except Exception as e:
             logger.error(f"Error getting model info: {e}")
             raise
 
 
+class AsyncEmbeddingServiceClient:
+    """Async client for the Embedding Service API, for overlapping embedding calls with other I/O"""
+
+    def __init__(self, base_url: str = None):
+        """
+        Initialize the async embedding service client
+
+        Args:
+            base_url: Base URL of the embedding service.
+                     Defaults to env var EMBEDDING_SERVICE_URL or http://localhost:8001
+        """
+        self.base_url = base_url or os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8001")
+        self.timeout = DEFAULT_TIMEOUT
+        self.binary_batch = True
+        self.msgpack_chunks = True
+        self._session = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=True,
+            timeout=self.timeout,
+            limits=POOL_LIMITS
+        )
+
+    async def aclose(self):
+        """Close the pooled HTTP session"""
+        await self._session.aclose()
+
+    async def embed_single(self, text: str) -> List[float]:
+        """Embed a single text string (see EmbeddingServiceClient.embed_single)"""
+        try:
+            response = await self._session.post("/embed", json={"text": text})
+            response.raise_for_status()
+            return response.json()["embedding"]
+        except Exception as e:
+            logger.error(f"Error embedding single text: {e}")
+            raise
+
+    async def embed_batch(self, texts: List[str]) -> np.ndarray:
+        """Embed multiple texts in batch (see EmbeddingServiceClient.embed_batch)"""
+        try:
+            if self.binary_batch:
+                response = await self._session.post("/embed-batch-binary", json={"texts": texts})
+                if response.status_code != 404:
+                    response.raise_for_status()
+                    return _decode_binary_batch(response)
+                logger.info("Binary batch route not available, using JSON route")
+                self.binary_batch = False
+
+            response = await self._session.post("/embed-batch", json={"texts": texts})
+            response.raise_for_status()
+            return _decode_json_batch(response)
+        except Exception as e:
+            logger.error(f"Error embedding batch: {e}")
+            raise
+
+    async def embed_chunks(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Embed chunks data structure (see EmbeddingServiceClient.embed_chunks)"""
+        try:
+            if self.msgpack_chunks:
+                response = await self._session.post(
+                    "/embed-chunks-msgpack",
+                    content=ormsgpack.packb({"chunks": chunks}, option=ormsgpack.OPT_SERIALIZE_NUMPY),
+                    headers=MSGPACK_HEADERS
+                )
+                if response.status_code != 404:
+                    response.raise_for_status()
+                    return ormsgpack.unpackb(response.content)["chunks"]
+                logger.info("MessagePack chunks route not available, using JSON route")
+                self.msgpack_chunks = False
+
+            response = await self._session.post("/embed-chunks", json={"chunks": chunks})
+            response.raise_for_status()
+            return orjson.loads(response.content)["chunks"]
+        except Exception as e:
+            logger.error(f"Error embedding chunks: {e}")
+            raise
+
+    async def embed_chunks_concurrently(
+        self,
+        chunks: List[Dict[str, Any]],
+        batch_size: int = CHUNKS_PER_REQUEST,
+        max_concurrency: int = MAX_CONCURRENT_REQUESTS
+    ) -> List[Dict[str, Any]]:
+        """
+        Embed chunks as several sub-batch requests in flight at once
+        Overlaps the round trips instead of sending one request sized by the whole document
+
+        Args:
+            chunks: List of chunk dictionaries with 'text' field
+            batch_size: Chunks per request
+            max_concurrency: Most requests in flight at the same time
+
+        Returns:
+            List[Dict[str, Any]]: Chunks with added 'vector' field, in input order
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def embed(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            async with semaphore:
+                return await self.embed_chunks(batch)
+
+        results = await asyncio.gather(*(
+            embed(chunks[start:start + batch_size]) for start in range(0, len(chunks), batch_size)
+        ))
+        return [chunk for batch in results for chunk in batch]
+
+
 # Singleton instance for convenience
 _client = None
 
 def get_embedding_client(base_url: str = None) -> EmbeddingServiceClient:
     """
     Get or create the embedding service client singleton
-    
+
     Args:
         base_url: Optional base URL to override default
-        
+
     Returns:
         EmbeddingServiceClient: Client instance
     """
@@ -4,63 +4,59 @@ Uses Weaviate v4 collections API for consistency with vector_db.py
 """
 
 import os
-from typing import List, Optional
+import asyncio
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
 import weaviate
 from weaviate.classes.query import MetadataQuery
 import logging
 
+from helpers.vector_db import get_client
+from helpers.embedding_client import get_embedding_client
+
 logger = logging.getLogger(__name__)
 
 DOCUMENT_COLLECTION = os.getenv("WEAVIATE_DOCUMENT_COLLECTION", "IT_Chatbot_Document")
 CHUNK_COLLECTION = os.getenv("WEAVIATE_CHUNK_COLLECTION", "DocChunk")
+# Chunks go into the prompt in relevance order, most relevant first. Setting this sorts them
+# by (filename, chunk_index) instead, so the same set of chunks always yields byte-identical
+# context that the LLM provider can cache, at the cost of losing the ranking
+STABLE_CONTEXT_ORDER = os.getenv("RAG_STABLE_CONTEXT_ORDER", "false").lower() == "true"
+# Bound once: "[filename | title | chunk:N]" traceability prefix followed by the chunk text
+_format_chunk = "[{} | {} | chunk:{}]\n{}".format
 
 
-def create_client() -> Optional[weaviate.WeaviateClient]:
-    """Create a Weaviate client using environment variables.
+@lru_cache(maxsize=1024)
+def embed_query(text: str) -> Tuple[float, ...]:
+    """Embed a search query with our embedding service, caching repeated queries."""
+    return tuple(get_embedding_client().embed_single(text))
 
-    Falls back to Docker service defaults if env vars are not provided.
-    Returns None if connection fails.
-    """
-    try:
-        http_host = os.getenv("WEAVIATE_HOST", "weaviate")
-        http_port = int(os.getenv("WEAVIATE_PORT", 8080))
-        grpc_host = os.getenv("WEAVIATE_HOST", "weaviate")
-        grpc_port = int(os.getenv("WEAVIATE_GRPC_PORT", 50051))
-
-        client = weaviate.connect_to_custom(
-            http_host=http_host,
-            http_port=http_port,
-            grpc_host=grpc_host,
-            grpc_port=grpc_port
-        )
-        # quick health check
-        if not client.is_ready():
-            logger.warning("Weaviate client not ready")
-            return None
-        return client
-    except Exception as e:
-        logger.error(f"❌ Weaviate connection error: {e}")
-        return None
 
-
-def get_rag_context(search_query: str, lang: str = "en", top_k: int = 7) -> str:
+def get_rag_context(
+    search_query: str, lang: str = "en", top_k: int = 7, embedding: Optional[Sequence[float]] = None
+) -> str:
     """Query Weaviate for the most relevant chunks and return a combined context string.
 
     Uses the Weaviate v4 collections API with hybrid search (text + vector).
+    The collection stores self-provided vectors, so the query vector is computed
+    by our embedding service and passed to Weaviate.
 
     Args:
         search_query: The user-search query (already optimized).
         lang: Language code (not used currently, reserved for future filters).
         top_k: Number of chunks to retrieve.
+        embedding: Precomputed embedding of search_query, to avoid embedding it again.
 
     Returns:
         A single string containing concatenated chunk texts (suitable for prompt context).
     """
-    client = create_client()
+    client = get_client()
     if not client:
         return ""  # Empty context on failure
 
     try:
+        query_vector = list(embedding if embedding is not None else embed_query(search_query))
+
         # Get the chunk collection using v4 API
         chunk_collection = client.collections.get(CHUNK_COLLECTION)
         
@@ -68,16 +64,17 @@ def get_rag_context(search_query: str, lang: str = "en", top_k: int = 7) -> str:
         try:
             results = chunk_collection.query.hybrid(
                 query=search_query,
+                vector=query_vector,
                 alpha=0.5,  # Balance between keyword (0) and vector (1) search
                 limit=top_k,
                 return_metadata=MetadataQuery(score=True)
             )
         except Exception as hybrid_error:
-            logger.warning(f"Hybrid search failed, falling back to near_text: {hybrid_error}")
+            logger.warning(f"Hybrid search failed, falling back to near_vector: {hybrid_error}")
             # Fallback to pure vector search if hybrid is not available
             try:
-                results = chunk_collection.query.near_text(
-                    query=search_query,
+                results = chunk_collection.query.near_vector(
+                    near_vector=query_vector,
                     limit=top_k,
                     return_metadata=MetadataQuery(distance=True)
                 )
@@ -85,40 +82,45 @@ def get_rag_context(search_query: str, lang: str = "en", top_k: int = 7) -> str:
                 logger.error(f"Vector search also failed: {vector_error}")
                 return ""
 
-        # Process results
-        items = []
-        for obj in results.objects:
+        objects = results.objects
+        if STABLE_CONTEXT_ORDER:
+            objects = sorted(
+                objects,
+                key=lambda obj: (obj.properties.get("filename") or "", obj.properties.get("chunk_index") or 0)
+            )
+
+        # Build each chunk with its traceability prefix, then join once
+        parts = []
+        for obj in objects:
             props = obj.properties
             text = props.get("text") or ""
             title = props.get("title") or ""
             filename = props.get("filename") or ""
             chunk_index = props.get("chunk_index")
             
-            # Build context prefix for traceability
-            prefix = ""
             if filename or title or chunk_index is not None:
-                prefix = f"[{filename} | {title} | chunk:{chunk_index}]\n"
-            
-            items.append(prefix + text)
+                parts.append(_format_chunk(filename, title, chunk_index, text))
+            else:
+                parts.append(text)
 
-        # Concatenate with separators
-        context = "\n\n---\n\n".join(items)
-        return context
+        return "\n\n---\n\n".join(parts)
 
     except Exception as e:
         logger.error(f"Error during retrieval: {e}")
         return ""
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
+
+
+async def get_rag_context_async(
+    search_query: str, lang: str = "en", top_k: int = 7, embedding: Optional[Sequence[float]] = None
+) -> str:
+    """Async wrapper of get_rag_context, runs the blocking Weaviate query in a worker thread."""
+    return await asyncio.to_thread(get_rag_context, search_query, lang, top_k, embedding)
 
 
 if __name__ == "__main__":
     # Simple sanity check
     logging.basicConfig(level=logging.INFO)
-    c = create_client()
+    c = get_client()
     if c:
         print("✅ Weaviate client ready")
         try:
@@ -126,9 +128,5 @@ if __name__ == "__main__":
             print(f"Available collections: {list(collections.keys())}")
         except Exception as e:
             print(f"Could not list collections: {e}")
-        try:
-            c.close()
-        except Exception:
-            pass
     else:
         print("❌ Failed to connect to Weaviate")
\ No newline at end of file
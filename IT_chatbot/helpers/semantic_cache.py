@@ -0,0 +1,113 @@
+"""
+Semantic answer cache
+Returns a stored answer when a new question embeds close to one already answered,
+so paraphrased repeats skip retrieval and generation
+"""
+
+import os
+import time
+import threading
+import logging
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from helpers.retrieval import embed_query
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+CACHE_TTL_SECONDS = int(os.getenv("CHAIN_TTL_SECONDS", 3600))  # Same lifetime as chat chains
+MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 5000))  # Per language
+
+
+class _LanguageCache:
+    """Fixed-capacity store of normalized query vectors and their answers, evicted by least recent use"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((MAX_ENTRIES, dim), dtype=np.float32)
+        self.answers = [None] * MAX_ENTRIES
+        self.created = np.full(MAX_ENTRIES, -np.inf)
+        self.last_used = np.full(MAX_ENTRIES, -np.inf)
+        self.size = 0
+
+    def lookup(self, vector: np.ndarray, now: float) -> Optional[str]:
+        if not self.size:
+            return None
+        scores = self.vectors[:self.size] @ vector
+        scores[self.created[:self.size] < now - CACHE_TTL_SECONDS] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] < SIMILARITY_THRESHOLD:
+            return None
+        self.last_used[best] = now
+        return self.answers[best]
+
+    def store(self, vector: np.ndarray, answer: str, now: float):
+        if self.size < MAX_ENTRIES:
+            slot = self.size
+            self.size += 1
+        else:
+            # Expired entries were last used before their TTL ran out, so they go first
+            slot = int(np.argmin(self.last_used))
+        self.vectors[slot] = vector
+        self.answers[slot] = answer
+        self.created[slot] = now
+        self.last_used[slot] = now
+
+
+_caches: Dict[str, _LanguageCache] = {}
+_lock = threading.Lock()
+
+
+def _normalized_embedding(query: str, embedding: Optional[Sequence[float]]) -> np.ndarray:
+    vector = np.asarray(embedding if embedding is not None else embed_query(query), dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+def lookup(query: str, lang: str, embedding: Optional[Sequence[float]] = None) -> Optional[str]:
+    """
+    Find a cached answer for a semantically equivalent question
+
+    Args:
+        query: The user question
+        lang: Language code, answers are only reused within the same language
+        embedding: Precomputed embedding of query, embedded here if not given
+
+    Returns:
+        The cached answer, or None on a miss
+    """
+    try:
+        vector = _normalized_embedding(query, embedding)
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup skipped: {e}")
+        return None
+
+    with _lock:
+        cache = _caches.get(lang)
+        answer = cache.lookup(vector, time.time()) if cache else None
+    if answer is not None:
+        logger.info("Semantic cache hit")
+    return answer
+
+
+def store(query: str, lang: str, answer: str, embedding: Optional[Sequence[float]] = None):
+    """
+    Cache the answer to a question
+
+    Args:
+        query: The user question
+        lang: Language code of the question
+        answer: The final answer returned to the user
+        embedding: Precomputed embedding of query, embedded here if not given
+    """
+    try:
+        vector = _normalized_embedding(query, embedding)
+    except Exception as e:
+        logger.warning(f"Semantic cache store skipped: {e}")
+        return
+
+    with _lock:
+        cache = _caches.get(lang)
+        if cache is None:
+            cache = _caches[lang] = _LanguageCache(vector.shape[0])
+        cache.store(vector, answer, time.time())
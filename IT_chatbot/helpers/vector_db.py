@@ -10,11 +10,21 @@ import weaviate.classes as wvc
 from weaviate.classes.data import DataObject
 from weaviate.util import generate_uuid5
 from typing import List, Dict, Any
+from functools import lru_cache
+import atexit
 import os 
+import numpy as np
 
 DOCUMENT_COLLECTION = "IT_Chatbot_Document"
 CHUNK_COLLECTION = "DocChunk"
 
+# Objects per gRPC batch request and how many requests are in flight at once, tunable per cluster
+WEAVIATE_BATCH_SIZE = int(os.getenv("WEAVIATE_BATCH_SIZE", 200))
+WEAVIATE_CONCURRENT_REQUESTS = int(os.getenv("WEAVIATE_CONCURRENT_REQUESTS", 4))
+
+# Set once define_schema has run in this process
+_schema_ready = False
+
 def create_client():
     """Connects to Weaviate using Docker service names."""
     try:
@@ -29,11 +39,29 @@ def create_client():
         print(f"❌ Weaviate Connection Error: {e}")
         return None
 
+@lru_cache(maxsize=1)
+def _cached_client():
+    client = create_client()
+    if client:
+        atexit.register(client.close)
+    return client
+
+def get_client():
+    """Returns a process-wide Weaviate client, reconnecting if the cached one is down."""
+    client = _cached_client()
+    if client is None or not client.is_connected():
+        _cached_client.cache_clear()
+        client = _cached_client()
+    return client
+
 def define_schema(client: weaviate.WeaviateClient):
     """
     Creates the 'Document' and 'DocChunk' collections in Weaviate.
     """
-    if not client.collections.exists(DOCUMENT_COLLECTION):
+    # One request lists every collection instead of an exists() round-trip per collection
+    existing = client.collections.list_all(simple=True)
+
+    if DOCUMENT_COLLECTION not in existing:
         print(f"Creating '{DOCUMENT_COLLECTION}' collection...")
         client.collections.create(
             name=DOCUMENT_COLLECTION,
@@ -60,7 +88,7 @@ def define_schema(client: weaviate.WeaviateClient):
             vector_config=wvc.config.Configure.Vectors.self_provided()
         )
     
-    if not client.collections.exists(CHUNK_COLLECTION):
+    if CHUNK_COLLECTION not in existing:
         print("Creating 'DocChunk' collection...")
         client.collections.create(
             name="DocChunk",
@@ -101,7 +129,7 @@ def define_schema(client: weaviate.WeaviateClient):
                     data_type=DataType.TEXT_ARRAY, 
                     tokenization="keyword"
                     ),
-                Property(name="bounding_boxes", data_type=DataType.TEXT_ARRAY), # Storing as JSON strings
+                Property(name="bounding_boxes", data_type=DataType.NUMBER_ARRAY), # Flat [l, t, r, b, ...], 4 numbers per box
                 
                 # --- Foreign Key (for Postgres) ---
                 Property(name="chunk_id", data_type=DataType.UUID, skip_vectorization=True), 
@@ -113,47 +141,91 @@ def define_schema(client: weaviate.WeaviateClient):
             # --- Vector Config ---
             # Tell Weaviate we are providing our own vectors
             vector_config=wvc.config.Configure.Vectors.self_provided(),
+            # PQ keeps 128 one-byte codes per 1024-d vector in memory instead of 4 KB of fp32.
+            # With ASYNC_INDEXING enabled on the server (see docker-compose.yml), Weaviate trains the
+            # codebook automatically once training_limit vectors are indexed; without it vectors stay uncompressed
             vector_index_config=Configure.VectorIndex.hnsw(
-                distance_metric=weaviate.classes.config.VectorDistances.COSINE
+                distance_metric=weaviate.classes.config.VectorDistances.COSINE,
+                quantizer=Configure.VectorIndex.Quantizer.pq(
+                    segments=128,
+                    centroids=256,
+                    training_limit=100_000
+                )
             )
         )
     print("Schema is ready.")
 
 
-def insert_to_weaviate(ingestion_data: Dict[str, Any]):
-    client = create_client()
+def _ready_client():
+    """Returns the shared client, making sure the schema was defined once in this process."""
+    global _schema_ready
+    client = get_client()
+    if client and not _schema_ready:
+        define_schema(client)
+        _schema_ready = True
+    return client
+
+
+def _report_failed_objects(failed_objects) -> int:
+    """Prints the objects Weaviate rejected in the last batch and returns how many there were."""
+    if failed_objects:
+        print(f"ERROR: {len(failed_objects)} objects were rejected by Weaviate, first error: {failed_objects[0].message}")
+    return len(failed_objects)
+
+
+def insert_document(parent_doc_data: Dict[str, Any]):
+    """Inserts the parent Document node."""
+    client = _ready_client()
     if not client: return
 
-    try:
-        # 1. Ensure schema exists using your existing logic
-        define_schema(client) 
+    doc_coll = client.collections.get(DOCUMENT_COLLECTION)
+    doc_coll.data.insert(
+        properties={
+            "doc_hash": parent_doc_data["doc_hash"],
+            "filename": parent_doc_data["filename"],
+            "mimetype": parent_doc_data["mimetype"],
+        },
+        uuid=parent_doc_data["uuid"]
+    )
 
+
+def insert_chunks(parent_doc_uuid, chunks_data: List[Dict[str, Any]]):
+    """Batch inserts chunks (with their 'vector') linked to the parent Document."""
+    client = _ready_client()
+    if not client: return
+
+    # One contiguous fp32 matrix instead of a Python float list per chunk
+    vectors = np.asarray([c.pop("vector") for c in chunks_data], dtype=np.float32)
+    chunk_coll = client.collections.get(CHUNK_COLLECTION)
+    with chunk_coll.batch.fixed_size(
+        batch_size=WEAVIATE_BATCH_SIZE,
+        concurrent_requests=WEAVIATE_CONCURRENT_REQUESTS
+    ) as batch:
+        for i, c in enumerate(chunks_data):
+            batch.add_object(
+                properties=c,
+                vector=vectors[i],
+                # Same id as the Postgres row, no mapping needed between the stores
+                uuid=c["chunk_id"],
+                references={"fromDocument": parent_doc_uuid}
+            )
+
+    # Objects still in flight are only sent when the context exits, so the failures
+    # are read right after it, before another batch on this collection resets them
+    _report_failed_objects(list(chunk_coll.batch.failed_objects))
+
+
+def insert_to_weaviate(ingestion_data: Dict[str, Any]):
+    try:
         parent_doc_data = ingestion_data.get("document")
         chunks_data = ingestion_data.get("chunks")
-        parent_doc_uuid = parent_doc_data["uuid"]
-
-        # 2. Insert Document
-        doc_coll = client.collections.get(DOCUMENT_COLLECTION)
-        doc_coll.data.insert(
-            properties={
-                "doc_hash": parent_doc_data["doc_hash"],
-                "filename": parent_doc_data["filename"],
-                "mimetype": parent_doc_data["mimetype"],
-            },
-            uuid=parent_doc_uuid
-        )
 
-        # 3. Batch Insert Chunks
-        chunk_coll = client.collections.get(CHUNK_COLLECTION)
-        with chunk_coll.batch.fixed_size(batch_size=50) as batch:
-            for c in chunks_data:
-                vector = c.pop("vector", None)
-                c.pop("parent_doc_uuid", None)
-                batch.add_object(
-                    properties=c,
-                    vector=vector,
-                    references={"fromDocument": parent_doc_uuid}
-                )
+        # 1. Insert Document
+        insert_document(parent_doc_data)
+
+        # 2. Batch Insert Chunks
+        insert_chunks(parent_doc_data["uuid"], chunks_data)
         print("✅ Weaviate ingestion complete.")
-    finally:
-        client.close()
\ No newline at end of file
+    except Exception as e:
+        print(f"❌ Weaviate ingestion failed: {e}")
+        raise
@@ -1,20 +1,28 @@
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_community.chat_message_histories import RedisChatMessageHistory
 import os
 from dotenv import load_dotenv
 import re
-from typing import Dict, Tuple
-from langdetect import detect
+from typing import AsyncIterator, Dict, Optional, Tuple
+from collections import OrderedDict
+from functools import lru_cache
 import time
 import threading
+import asyncio
+import logging
 
 from helpers.date_agent import DateAgent
-from helpers.retrieval import get_rag_context
+from helpers.retrieval import embed_query, get_rag_context, get_rag_context_async
+from helpers import semantic_cache
+from helpers.text_cleaning import clean_response, clean_stream
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # -- date agent --
 date_agent = DateAgent(timezone=os.getenv("DEFAULT_TIMEZONE", "Africa/Cairo"))
 
@@ -30,257 +38,262 @@ llm = ChatOpenAI(
 )
 
 # =============================================================================
-# Memory Management with TTL Eviction
+# Memory Management (chat history in Redis)
 # =============================================================================
 
 # Configuration
-MAX_TOKEN_LIMIT = 500
-CHAIN_TTL_SECONDS = int(os.getenv("CHAIN_TTL_SECONDS", 3600))  # Default 1 hour
-MAX_CHAINS = int(os.getenv("MAX_CHAINS", 1000))  # Maximum number of chains to store
-CLEANUP_INTERVAL_SECONDS = 300  # Run cleanup every 5 minutes
-
-# In-memory store for user chat chains with timestamps
-# Format: {user_id: (chain, last_access_timestamp, language)}
-chat_chains: Dict[str, Tuple[LLMChain, float, str]] = {}
-chains_lock = threading.Lock()
-
-
-def cleanup_expired_chains():
-    """Remove expired chains based on TTL and enforce max chain limit."""
-    current_time = time.time()
-    with chains_lock:
-        # Remove expired chains
-        expired_users = [
-            user_id for user_id, (_, last_access, _) in chat_chains.items()
-            if current_time - last_access > CHAIN_TTL_SECONDS
-        ]
-        for user_id in expired_users:
-            del chat_chains[user_id]
-        
-        if expired_users:
-            print(f"🧹 Cleaned up {len(expired_users)} expired chat chains")
-        
-        # If still over limit, remove oldest chains (LRU eviction)
-        if len(chat_chains) > MAX_CHAINS:
-            sorted_by_access = sorted(
-                chat_chains.items(),
-                key=lambda x: x[1][1]  # Sort by last_access timestamp
-            )
-            to_remove = len(chat_chains) - MAX_CHAINS
-            for user_id, _ in sorted_by_access[:to_remove]:
-                del chat_chains[user_id]
-            print(f"🧹 LRU evicted {to_remove} chat chains (over limit)")
-
-
-def start_cleanup_scheduler():
-    """Start a background thread for periodic cleanup."""
-    def run_cleanup():
-        while True:
-            time.sleep(CLEANUP_INTERVAL_SECONDS)
-            try:
-                cleanup_expired_chains()
-            except Exception as e:
-                print(f"Error during cleanup: {e}")
-    
-    cleanup_thread = threading.Thread(target=run_cleanup, daemon=True)
-    cleanup_thread.start()
-
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", 3))  # Question/answer pairs kept in memory
+CHAIN_TTL_SECONDS = int(os.getenv("CHAIN_TTL_SECONDS", 3600))  # Redis expiry of a user's history, default 1 hour
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+MAX_CHAINS = int(os.getenv("MAX_CHAINS", 1000))  # Chains kept in this process
+CHAIN_CACHE_SECONDS = 60  # How long an idle chain is reused before it is rebuilt
 
-# Start the cleanup scheduler when module is loaded
-start_cleanup_scheduler()
+# The history itself lives in Redis, so every worker sees the same conversation and
+# Redis expires idle users. This process only keeps recently used chain objects around
+# so back-to-back turns reuse them and their Redis connection.
+# Format: {(user_id, language): (chain, last_access_timestamp)}, least recently used first
+recent_chains: "OrderedDict[Tuple[str, str], Tuple[LLMChain, float]]" = OrderedDict()
+recent_chains_lock = threading.Lock()
 
 
 # =============================================================================
 # Prompt Templates
 # =============================================================================
 
-english_template_str = """
-Identity:
- - You are the AI assistant for Beltone Holding.
- - Beltone a leading financial services provider in the MENA region, your purpose is to showcase our commitment to redefining the regional financial ecosystem through innovative, value-driven solutions.
- - Beltone is a holding company that has many subsidiaries and does not have branches.
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
 
-Mission:
- - Your main goal is to provide clear, concise, and engaging information about Beltone.
- - You should embody a tone that is professional yet warm and encouraging.
- - When answering questions, your communication style should be conversational and simple.
- - Feel free to use contractions and simplify complex topics into easy-to-understand concepts.
- - Use markdown to structure your answers clearly and cleanly.
-Rules:
- - ANSWER IN ENGLISH DESPITE OF THE HISTORY OR THE CONTEXT LANGUAGE.
- - Context is Key: Always base your answers on the provided context. Do not give information not mentioned in the context.Do not mention that you are using context to answer. Rephrase the context as you see fit.
- - No Hallucinations: Do not invent information. If you cannot answer a question based on the context, state that you do not have the information to help with that specific query.
- - Greetings: Only greet a user if they greet you first. If they do, greet them back and briefly introduce yourself as Beltone's assistant.
- - Relevance: You must avoid answering questions that are unrelated to Beltone or its services.
- - Originality: Never give the exact same answer twice.
- - Conciseness: Do not exceed 1000 characters in your response.
 
+@lru_cache(maxsize=2)
+def get_prompt(lang: str) -> PromptTemplate:
+    """Load and compile the prompt template for a language on first use."""
+    with open(os.path.join(PROMPTS_DIR, f"{lang}.txt"), encoding="utf-8") as f:
+        template = f.read()
+    return PromptTemplate(input_variables=["history", "input", "context"], template=template)
 
-Context:
-{context}
 
+# =============================================================================
+# Core Functions
+# =============================================================================
 
-{history}
+def get_or_create_conversation_chain(user_id: str, lang: str) -> LLMChain:
+    """
+    Get a recently used conversation chain or build a new one.
+    
+    The chain's memory reads and writes the user's history in Redis, so a rebuilt chain
+    continues the same conversation. Each language has its own chain with the matching
+    prompt template, both sharing the user's history.
+    """
+    key = (user_id, lang)
+    current_time = time.time()
+    
+    with recent_chains_lock:
+        entry = recent_chains.get(key)
+        if entry and current_time - entry[1] < CHAIN_CACHE_SECONDS:
+            recent_chains[key] = (entry[0], current_time)
+            recent_chains.move_to_end(key)
+            return entry[0]
+    
+    # Create new chain
+    # A fixed window needs no summarization LLM call once the history grows
+    memory = ConversationBufferWindowMemory(
+        chat_memory=RedisChatMessageHistory(session_id=user_id, url=REDIS_URL, ttl=CHAIN_TTL_SECONDS),
+        k=HISTORY_WINDOW_TURNS,
+        memory_key="history",
+        input_key="input",
+        return_messages=False
+    )
+    new_chain = LLMChain(
+        llm=llm,
+        memory=memory,
+        prompt=get_prompt("ar" if lang == "ar" else "en"),
+        verbose=False
+    )
+    
+    with recent_chains_lock:
+        recent_chains[key] = (new_chain, current_time)
+        recent_chains.move_to_end(key)
+        while len(recent_chains) > MAX_CHAINS:
+            recent_chains.popitem(last=False)
+    return new_chain
 
 
-Question:
-{input}
-"""
-english_prompt = PromptTemplate(input_variables=["history", "input", "context"], template=english_template_str)
+def load_history(conversation: LLMChain) -> str:
+    """The user's recent turns as prompt text, read from Redis (blocking)."""
+    if hasattr(conversation.memory, "buffer"):
+        return conversation.memory.buffer
+    return ""
 
-arabic_template_str = """
-الهوية:
-- أنت المساعد الافتراضي (AI assistant) لشركة بلتون القابضة (Beltone Holding).
-- بلتون هي شركة رائدة في تقديم الخدمات المالية في منطقة الشرق الأوسط وشمال أفريقيا، وهدفك هو إبراز التزامنا بإعادة تعريف النظام المالي الإقليمي من خلال حلول مبتكرة تقدم قيمة حقيقية.
-- بلتون هي شركة قابضة لديها العديد من الشركات التابعة وليس لديها فروع.
 
-المهمة:
-- هدفك الرئيسي هو تقديم معلومات واضحة وموجزة وجذابة عن بلتون.
-- يجب أن تتحلى بأسلوب مهني ولكن ودود ومشجع.
-- عند الإجابة على الأسئلة، يجب أن يكون أسلوب التواصل محادثاتي وبسيط.
-- لا تتردد في تبسيط المواضيع المعقدة إلى مفاهيم سهلة الفهم.
-- استخدم التنسيق (markdown) لتنظيم إجاباتك بوضوح.
+def save_turn(conversation: LLMChain, question: str, answer: str):
+    """Appends a question/answer turn to the user's Redis history (blocking)."""
+    conversation.memory.save_context({"input": question}, {"text": answer})
+    # The window only ever reads the newest turns, so older ones are trimmed instead of piling up.
+    # RedisChatMessageHistory pushes new messages to the head of the list
+    history = conversation.memory.chat_memory
+    history.redis_client.ltrim(history.key, 0, 2 * HISTORY_WINDOW_TURNS - 1)
 
-القواعد:
-- أجب باللغة العربية بغض النظر عن لغة السياق أو المحادثة السابقة.
-- السياق هو الأساس: ابني إجاباتك دائماً على السياق المقدم. لا تعطي معلومات غير مذكورة في السياق. لا تذكر أنك تستخدم السياق للإجابة. أعد صياغة السياق كما تراه مناسباً.
-- لا تختلق المعلومات: لا تخترع معلومات. إذا لم تستطع الإجابة على سؤال بناءً على السياق، اذكر أنه ليس لديك المعلومات للمساعدة في هذا الاستفسار المحدد.
-- التحيات: رد التحية فقط إذا بدأ المستخدم بالتحية. إذا فعل ذلك، رد التحية وقدم نفسك بإيجاز كمساعد بلتون.
-- الصلة بالموضوع: يجب أن تتجنب الإجابة على الأسئلة التي لا تتعلق ببلتون أو خدماتها.
-- الأصالة: لا تعطي نفس الإجابة مرتين.
-- الإيجاز: لا تتجاوز 1000 حرف في إجابتك.
 
+ARABIC_CHAR_PATTERN = re.compile(r"[\u0600-\u06FF\u0750-\u077F]")
+LETTER_PATTERN = re.compile(r"[^\W\d_]")
 
-السياق:
-{context}
 
+def detect_language(text):
+    # Only Arabic vs English matters here: Arabic if at least a third of the letters
+    # are Arabic script, so Arabic questions that mention English names stay Arabic
+    arabic = len(ARABIC_CHAR_PATTERN.findall(text))
+    return "ar" if arabic and arabic * 3 >= len(LETTER_PATTERN.findall(text)) else "en"
 
-{history}
 
+# Pronouns/demonstratives that point back to an earlier turn
+FOLLOW_UP_PATTERN = re.compile(
+    r"\b(it|its|this|that|they|them|those|these|هذا|هذه|ذلك|هم)\b",
+    re.IGNORECASE
+)
 
-السؤال:
-{input}
-"""
-arabic_prompt = PromptTemplate(input_variables=["history", "input", "context"], template=arabic_template_str)
 
+# Turns a follow-up into a standalone search query, run without memory so it adds nothing to the history
+FOLLOW_UP_REWRITE_PROMPT = PromptTemplate(
+    input_variables=["history", "question"],
+    template=(
+        "Given the conversation below, rewrite the user's follow-up question as a standalone search query "
+        "that names what it refers to. Keep the language of the question. "
+        "Respond with only the query.\n\n"
+        "Conversation:\n{history}\n\n"
+        "Follow-up question: {question}\n"
+        "Search query:"
+    )
+)
 
-# =============================================================================
-# Core Functions
-# =============================================================================
 
-def get_or_create_conversation_chain(user_id: str, lang: str) -> LLMChain:
-    """
-    Get an existing conversation chain or create a new one.
-    
-    Implements language switching: if user switches language, recreate the chain
-    with the appropriate prompt template.
-    """
-    current_time = time.time()
-    
-    with chains_lock:
-        if user_id in chat_chains:
-            chain, last_access, stored_lang = chat_chains[user_id]
-            
-            # Check if language changed - if so, create new chain
-            if stored_lang != lang:
-                print(f"🔄 Language switch detected for user {user_id}: {stored_lang} -> {lang}")
-                # Remove old chain to create new one with correct language
-                del chat_chains[user_id]
-            else:
-                # Update access time and return existing chain
-                chat_chains[user_id] = (chain, current_time, stored_lang)
-                return chain
-        
-        # Create new chain
-        memory = ConversationSummaryBufferMemory(
-            llm=llm,
-            max_token_limit=MAX_TOKEN_LIMIT,
-            memory_key="history",
-            input_key="input",
-            return_messages=False
-        )
-        prompt_template = arabic_prompt if lang == "ar" else english_prompt
-        new_chain = LLMChain(
-            llm=llm,
-            memory=memory,
-            prompt=prompt_template,
-            verbose=False
-        )
-        chat_chains[user_id] = (new_chain, current_time, lang)
-        return new_chain
+def is_follow_up(question: str, history: str) -> bool:
+    """Cheap local check for whether the question depends on the previous conversation."""
+    return bool(history) and FOLLOW_UP_PATTERN.search(question) is not None
 
 
-def detect_language(text):
-    try:
-        return "ar" if detect(text) == 'ar' else "en"
-    except Exception:
-        return "en"
-
-
-def classify_question_type(question: str, history: str, llm) -> str:
-    prompt = f"""
-    Given the following conversation history:
-    {history}
-    And this new user question:
-    {question}
-    Determine if the new question is:
-    - A 'follow-up' (refers to or depends on the previous conversation), or
-    - A 'new question' (does not depend on previous context).
-
-    Respond with only: 'follow-up' or 'new question'.
+async def prepare_answer(question: str, user_id: str, top_k: int = 7) -> Tuple[LLMChain, Optional[str], Dict, Optional[Tuple]]:
     """
+    Run everything that comes before generation for one user turn.
+
+    Returns:
+        (conversation, cached_answer, chain_inputs, cache_entry): cached_answer is set on a
+        semantic cache hit, otherwise chain_inputs are the prompt inputs to generate from and
+        cache_entry is the (lang, embedding) to store the answer under, if it is cacheable.
+    """
+    lang = detect_language(question)
+    # Building the chain's Redis history and reading it are blocking round trips, keep them off the event loop
+    conversation = await asyncio.to_thread(get_or_create_conversation_chain, user_id, lang)
+    history = await asyncio.to_thread(load_history, conversation)
+
+    follow_up = is_follow_up(question, history)
+    date_related = date_agent.is_date_related_query(question)
+    # Follow-ups depend on the conversation and date-relative answers change over time,
+    # so only standalone questions go through the semantic cache
+    cacheable = not follow_up and not date_related
+    embedding = None
+
+    if follow_up:
+        # The history-aware rewrite resolves what the follow-up refers to before retrieval.
+        # A first turn has no history, is never a follow-up, and is searched as asked
+        try:
+            rewrite = await (FOLLOW_UP_REWRITE_PROMPT | llm).ainvoke({"history": history, "question": question})
+            search_query = rewrite.content.strip() or question
+        except Exception:
+            search_query = question
+        rag_context = await get_rag_context_async(search_query, lang, top_k)
+    elif cacheable:
+        # Embed once and share the vector between the cache lookup and retrieval
+        try:
+            embedding = await asyncio.to_thread(embed_query, question)
+        except Exception:
+            pass
+        cached = semantic_cache.lookup(question, lang, embedding) if embedding is not None else None
+        if cached is not None:
+            # Keep the turn in memory so follow-ups still see it
+            await asyncio.to_thread(save_turn, conversation, question, cached)
+            return conversation, cached, {}, None
+        rag_context = await get_rag_context_async(question, lang, top_k, embedding)
+    else:
+        rag_context = await get_rag_context_async(question, lang, top_k)
+
+    if date_related:
+        rag_context = date_agent.enhance_context_with_date(rag_context, question)
+
+    injected_history = history if follow_up else ""
+    chain_inputs = {"input": question, "context": rag_context, "history": injected_history}
+    cache_entry = (lang, embedding) if cacheable and embedding is not None else None
+    return conversation, None, chain_inputs, cache_entry
+
+
+async def rag_answer_with_memory(question: str, user_id: str, top_k: int = 7) -> str:
+    conversation, cached, chain_inputs, cache_entry = await prepare_answer(question, user_id, top_k)
+    if cached is not None:
+        return cached
+
     try:
-        answer = llm.invoke(prompt).content.strip().lower()
-        return answer
-    except Exception:
-        return "new question"
+        # The chain's own memory would write to Redis on the event loop, so the turn is recorded below
+        response = (await (conversation.prompt | conversation.llm).ainvoke(chain_inputs)).content
+        response_clean = clean_response(response)
+    except Exception as e:
+        return f"❌ An error occurred: {e}"
 
+    await asyncio.to_thread(save_turn, conversation, question, response)
 
-def clean_response(response: str) -> str:
-    response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL)
-    response = re.sub(r"[*_#]+", "", response)
-    response = re.sub(r"\s+", " ", response).strip()
-    response = re.sub(r"[{}]+", "", response)
-    return response
+    if cache_entry:
+        semantic_cache.store(question, cache_entry[0], response_clean, cache_entry[1])
+    return response_clean
 
 
-def rag_answer_with_memory(question: str, user_id: str, top_k: int = 7) -> str:
-    lang = detect_language(question)
-    conversation = get_or_create_conversation_chain(user_id, lang)
-    history = ""
-    if hasattr(conversation.memory, "buffer"):
-        history = conversation.memory.buffer
+async def rag_answer_stream(question: str, user_id: str, top_k: int = 7) -> AsyncIterator[str]:
+    """Same as rag_answer_with_memory, but yields the answer as it is generated."""
+    conversation, cached, chain_inputs, cache_entry = await prepare_answer(question, user_id, top_k)
+    if cached is not None:
+        yield cached
+        return
+
+    response_parts = []
+
+    async def generate() -> AsyncIterator[str]:
+        async for chunk in (conversation.prompt | conversation.llm).astream(chain_inputs):
+            response_parts.append(chunk.content)
+            yield chunk.content
 
-    question_type = classify_question_type(question, history, llm)
-    search_query = question  # simple fallback
     try:
-        search_query = conversation.predict(input=question, context="", history=history)
-    except Exception:
-        search_query = question
+        async for text in clean_stream(generate()):
+            yield text
+    except Exception as e:
+        yield f"❌ An error occurred: {e}"
+        return
 
-    rag_context = get_rag_context(search_query, lang, top_k)
-    rag_context = date_agent.enhance_context_with_date(rag_context, question)
+    # The chain is bypassed while streaming, so record the turn and cache the answer here
+    response = "".join(response_parts)
+    await asyncio.to_thread(save_turn, conversation, question, response)
+    if cache_entry:
+        semantic_cache.store(question, cache_entry[0], clean_response(response), cache_entry[1])
 
-    injected_history = history if question_type == "follow-up" else ""
 
+WARMUP_USER_ID = "__warmup__"
+
+
+def warmup():
+    """
+    Pay one-time startup costs before the first real user does: compile both prompt
+    templates, build a chain, and open the Weaviate and embedding service connections.
+    """
     try:
-        response = conversation.predict(input=question, context=rag_context, history=injected_history)
-        response_clean = clean_response(response)
-        return response_clean
+        for lang in ("en", "ar"):
+            get_prompt(lang).format(history="", input="x", context="y")
+        get_or_create_conversation_chain(WARMUP_USER_ID, "en")
+        get_rag_context("Beltone", "en", 1)
+        logger.info("RAG pipeline warmed up")
     except Exception as e:
-        return f"❌ An error occurred: {e}"
+        logger.warning("Warmup failed, first request may be slow: %s", e)
 
 
 def get_chain_stats() -> Dict:
-    """Get statistics about the chat chains for monitoring."""
-    with chains_lock:
-        current_time = time.time()
+    """Get statistics about the chains cached in this process for monitoring."""
+    with recent_chains_lock:
         return {
-            "total_chains": len(chat_chains),
+            "cached_chains": len(recent_chains),
             "max_chains": MAX_CHAINS,
-            "ttl_seconds": CHAIN_TTL_SECONDS,
-            "oldest_chain_age": max(
-                (current_time - last_access for _, (_, last_access, _) in chat_chains.items()),
-                default=0
-            )
+            "ttl_seconds": CHAIN_TTL_SECONDS
         }
@@ -1,19 +1,28 @@
 import os
 import sys
 import uuid
+import asyncio
+import logging
 from typing import Optional
 
 
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
+# Configure logging once for the whole service
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="RAG Service")
 
 try:
-    from rag_generator import rag_answer_with_memory
+    from rag_generator import rag_answer_with_memory, rag_answer_stream, warmup
 except Exception as e:
     rag_answer_with_memory = None
-    print(f"Warning: could not import rag_generator.rag_answer_with_memory: {e}")
+    rag_answer_stream = None
+    warmup = None
+    logger.warning("Could not import rag_generator.rag_answer_with_memory: %s", e)
 
 
 class QueryRequest(BaseModel):
@@ -22,6 +31,13 @@ class QueryRequest(BaseModel):
     top_k: Optional[int] = 7
 
 
+@app.on_event("startup")
+async def startup_event():
+    """Warm up the RAG pipeline in the background so /health answers right away"""
+    if warmup is not None:
+        app.state.warmup_task = asyncio.create_task(asyncio.to_thread(warmup))
+
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
@@ -34,7 +50,23 @@ async def answer(req: QueryRequest):
 
     user_id = req.user_id or str(uuid.uuid4())
     try:
-        resp = rag_answer_with_memory(req.question, user_id, top_k=req.top_k)
+        resp = await rag_answer_with_memory(req.question, user_id, top_k=req.top_k)
         return {"answer": resp, "user_id": user_id}
     except Exception as e:
         return {"error": str(e)}
+
+
+@app.post("/answer/stream")
+async def answer_stream(req: QueryRequest):
+    """Stream the answer as server-sent events, one 'data:' event per generated piece."""
+    if rag_answer_stream is None:
+        return {"error": "RAG generation module not available on import."}
+
+    user_id = req.user_id or str(uuid.uuid4())
+
+    async def events():
+        async for text in rag_answer_stream(req.question, user_id, top_k=req.top_k):
+            yield f"data: {text}\n\n"
+        yield "event: end\ndata: \n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"X-User-Id": user_id})
@@ -14,7 +14,8 @@ DB_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 DB_PORT = os.getenv("POSTGRES_PORT") 
 
 MAX_RETRIES = 10
-RETRY_INTERVAL = 3
+RETRY_INTERVAL = 0.5  # seconds, doubled after every failed attempt
+MAX_RETRY_INTERVAL = 8
 
 def connect_with_retry(target_db):
     """Helper to connect to a specific database with retries."""
@@ -30,7 +31,7 @@ def connect_with_retry(target_db):
             return conn
         except Exception as e:
             print(f"Attempt {attempt + 1}: Could not connect to {target_db}. Retrying...")
-            time.sleep(RETRY_INTERVAL)
+            time.sleep(min(RETRY_INTERVAL * 2 ** attempt, MAX_RETRY_INTERVAL))
     return None
 
 def create_database_if_not_exists():
@@ -64,6 +65,56 @@ def create_database_if_not_exists():
         cursor.close()
         conn.close()
 
+# Deployments created before page_numbers, content_types and bounding_boxes became native arrays
+# still have them as JSONB, which the array COPY in helpers/DB.py cannot load into.
+# Converts any of those columns that are still JSONB, and does nothing on an up to date table.
+# Old bounding boxes are JSON strings of {"l", "t", "r", "b", ...} objects, flattened to [l, t, r, b, ...]
+MIGRATE_ARRAY_COLUMNS_SQL = """
+    CREATE OR REPLACE FUNCTION pg_temp.jsonb_to_int_array(j JSONB) RETURNS INTEGER[]
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT array_agg(e::INTEGER ORDER BY n)
+        FROM jsonb_array_elements_text(CASE WHEN jsonb_typeof(j) = 'array' THEN j ELSE '[]' END) WITH ORDINALITY AS a(e, n)
+    $$;
+
+    CREATE OR REPLACE FUNCTION pg_temp.jsonb_to_text_array(j JSONB) RETURNS TEXT[]
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT array_agg(e ORDER BY n)
+        FROM jsonb_array_elements_text(CASE WHEN jsonb_typeof(j) = 'array' THEN j ELSE '[]' END) WITH ORDINALITY AS a(e, n)
+    $$;
+
+    CREATE OR REPLACE FUNCTION pg_temp.jsonb_to_bbox_array(j JSONB) RETURNS DOUBLE PRECISION[]
+    LANGUAGE sql IMMUTABLE AS $$
+        SELECT array_agg(c.v ORDER BY a.n, c.k)
+        FROM jsonb_array_elements(CASE WHEN jsonb_typeof(j) = 'array' THEN j ELSE '[]' END) WITH ORDINALITY AS a(e, n),
+        LATERAL (SELECT CASE WHEN jsonb_typeof(a.e) = 'string' THEN (a.e #>> '{}')::JSONB ELSE a.e END AS box) AS b,
+        LATERAL (VALUES
+            (1, (b.box ->> 'l')::DOUBLE PRECISION),
+            (2, (b.box ->> 't')::DOUBLE PRECISION),
+            (3, (b.box ->> 'r')::DOUBLE PRECISION),
+            (4, (b.box ->> 'b')::DOUBLE PRECISION)
+        ) AS c(k, v)
+    $$;
+
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                   AND table_name = 'chunks' AND column_name = 'page_numbers' AND data_type = 'jsonb') THEN
+            ALTER TABLE chunks ALTER COLUMN page_numbers TYPE INTEGER[] USING pg_temp.jsonb_to_int_array(page_numbers);
+            RAISE NOTICE 'Migrated chunks.page_numbers to INTEGER[]';
+        END IF;
+        IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                   AND table_name = 'chunks' AND column_name = 'content_types' AND data_type = 'jsonb') THEN
+            ALTER TABLE chunks ALTER COLUMN content_types TYPE TEXT[] USING pg_temp.jsonb_to_text_array(content_types);
+            RAISE NOTICE 'Migrated chunks.content_types to TEXT[]';
+        END IF;
+        IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema()
+                   AND table_name = 'chunks' AND column_name = 'bounding_boxes' AND data_type = 'jsonb') THEN
+            ALTER TABLE chunks ALTER COLUMN bounding_boxes TYPE DOUBLE PRECISION[] USING pg_temp.jsonb_to_bbox_array(bounding_boxes);
+            RAISE NOTICE 'Migrated chunks.bounding_boxes to DOUBLE PRECISION[]';
+        END IF;
+    END $$;
+"""
+
 def create_database_schema():
     # 1. First, ensure the database itself exists
     if not create_database_if_not_exists():
@@ -86,11 +137,11 @@ def create_database_schema():
                 doc_hash TEXT NOT NULL,
                 chunk_index INTEGER NOT NULL,
                 filename TEXT,
-                page_numbers JSONB,
+                page_numbers INTEGER[],
                 title TEXT,
                 text TEXT NOT NULL,
-                content_types JSONB,
-                bounding_boxes JSONB,
+                content_types TEXT[],
+                bounding_boxes DOUBLE PRECISION[],
                 created_at TIMESTAMPTZ DEFAULT NOW()
             );
             
@@ -99,6 +150,7 @@ def create_database_schema():
         """
 
         cursor.execute(sql_script)
+        cursor.execute(MIGRATE_ARRAY_COLUMNS_SQL)
         print("Schema (tables and indexes) created successfully!")
 
     except Error as e:
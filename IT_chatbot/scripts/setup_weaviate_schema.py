@@ -31,9 +31,11 @@ def create_client():
 def setup_weaviate_schema():
     """Ensures the Weaviate graph schema (Document -> DocChunk) exists."""
     client = create_client()
+    # One request lists every collection instead of an exists() round-trip per collection
+    existing = client.collections.list_all(simple=True)
 
     # 1. Create Parent "Document" class
-    if not client.collections.exists(DOCUMENT_COLLECTION):
+    if DOCUMENT_COLLECTION not in existing:
         print(f"Creating Weaviate collection '{DOCUMENT_COLLECTION}'...")
         client.collections.create(
             name=DOCUMENT_COLLECTION,
@@ -49,7 +51,7 @@ def setup_weaviate_schema():
         print(f"'{DOCUMENT_COLLECTION}' collection already exists.")
 
     # 2. Create "DocChunk" class
-    if not client.collections.exists(CHUNK_COLLECTION):
+    if CHUNK_COLLECTION not in existing:
         print(f"Creating Weaviate collection '{CHUNK_COLLECTION}'...")
         client.collections.create(
             name=CHUNK_COLLECTION,
@@ -60,7 +62,7 @@ def setup_weaviate_schema():
                 Property(name="title", data_type=DataType.TEXT),
                 Property(name="page_numbers", data_type=DataType.NUMBER_ARRAY),
                 Property(name="content_types", data_type=DataType.TEXT_ARRAY),
-                Property(name="bounding_boxes", data_type=DataType.TEXT_ARRAY),
+                Property(name="bounding_boxes", data_type=DataType.NUMBER_ARRAY),
             ],
             vector_config=wvc.config.Configure.Vectors.self_provided(),
             # Create the link *from* DocChunk *to* Document
@@ -1,15 +1,18 @@
 import uuid
-from typing import List, Dict, Any
+import queue
+import asyncio
+import threading
+from typing import List, Dict, Any, Iterator, Union
 
 # # Your helper functions are now imported
 from helpers.DB import ingest_to_postgres
-from helpers.vector_db import insert_to_weaviate
-from helpers.embedding_client import get_embedding_client
+from helpers.vector_db import insert_to_weaviate, insert_document, insert_chunks
+from helpers.embedding_client import get_embedding_client, AsyncEmbeddingServiceClient
 
 # CHUNKING
 from docling.chunking import HybridChunker
 from docling.datamodel.accelerator_options import AcceleratorDevice, AcceleratorOptions
-from docling.datamodel.base_models import InputFormat
+from docling.datamodel.base_models import DocumentStream, InputFormat
 from docling.datamodel.pipeline_options import (
     PdfPipelineOptions,
 )
@@ -49,9 +52,14 @@ client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 embedding_client = get_embedding_client()
 
 # --- 2. DOCUMENT CONVERSION & CHUNKING ---
-def data_extractions(pdf_path: str) -> any:
-    print(f"Starting conversion for: {pdf_path}")
-    result = converter.convert(pdf_path)
+EMBED_BATCH_SIZE = 64  # Chunks per embedding request when streaming
+CHUNK_QUEUE_SIZE = 256
+
+def iter_chunks(source: Union[str, Path, DocumentStream]) -> Iterator[Any]:
+    """Converts a PDF given as a path or an in-memory DocumentStream and yields its chunks."""
+    name = source.name if isinstance(source, DocumentStream) else source
+    print(f"Starting conversion for: {name}")
+    result = converter.convert(source)
     print("Document conversion complete.")
 
     # For chunking, we'll use a simple tokenizer approach
@@ -61,65 +69,59 @@ def data_extractions(pdf_path: str) -> any:
         merge_peers=True,
     )
 
-    chunk_iter = chunker.chunk(dl_doc=result.document)
-    chunks = list(chunk_iter)
+    yield from chunker.chunk(dl_doc=result.document)
+
+
+def data_extractions(source: Union[str, Path, DocumentStream]) -> any:
+    """Converts and chunks a PDF, returning all chunks at once."""
+    chunks = list(iter_chunks(source))
     print(f"Document chunking complete. Found {len(chunks)} chunks.")
     return chunks
 
 
 # --- 3. DATA PROCESSING & EMBEDDING  ---
-def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
-    """
-    Processes chunks and returns a dictionary with:
-    1. A single 'document' object.
-    2. A list of 'chunks' objects.
-    """
-    processed_chunks = []
-    texts_to_embed = []
-    
-    # We only need the *first* chunk to get the parent doc info
-    if not docling_chunks:
-        return {"document": None, "chunks": []}
-        
-    first_meta = docling_chunks[0].meta
+def build_document_data(first_chunk: Any) -> Dict[str, Any]:
+    """Builds the parent 'document' object from the first chunk's origin."""
+    first_meta = first_chunk.meta
     doc_hash = str(first_meta.origin.binary_hash)
     
     # Use the hash to create a stable UUID for the parent Document
     parent_doc_uuid = uuid.uuid5(uuid.NAMESPACE_DNS, doc_hash)
 
-    parent_document_data = {
+    return {
         "doc_hash": doc_hash,
         "filename": first_meta.origin.filename,
         "mimetype": first_meta.origin.mimetype,
         "uuid": parent_doc_uuid
     }
-    
-    print(f"Processing {len(docling_chunks)} chunks for document: {first_meta.origin.filename}")
 
-    for i, chunk in enumerate(docling_chunks):
+
+def build_chunk_rows(docling_chunks: List[Any], document_data: Dict[str, Any], start_index: int = 0) -> List[Dict[str, Any]]:
+    """Extracts the metadata rows for a list of chunks, numbering them from start_index."""
+    processed_chunks = []
+
+    for i, chunk in enumerate(docling_chunks, start=start_index):
         chunk_id = uuid.uuid4() # This is the Postgres Primary Key
         meta = chunk.meta
         
         # --- Extract Rich Metadata ---
-        page_nos = list(sorted(set(
-            prov.page_no for item in meta.doc_items for prov in item.prov
-        )))
+        # One pass over the doc items fills the page numbers, content types and bboxes together
+        page_no_set, content_type_set, bounding_boxes = set(), set(), []
+        for item in meta.doc_items:
+            content_type_set.add(item.label.name.lower())
+            for prov in item.prov:
+                page_no_set.add(prov.page_no)
+                bbox = prov.bbox
+                # Store bboxes as one flat number list, [l, t, r, b] per provenance box
+                bounding_boxes.extend((bbox.l, bbox.t, bbox.r, bbox.b))
+        page_nos = sorted(page_no_set)
+        content_types = list(content_type_set)
         
         title = meta.headings[0] if meta.headings else None
         
-        content_types = list(set(
-            item.label.name.lower() for item in meta.doc_items
-        ))
-
-        # Store bboxes as a list of JSON strings
-        bounding_boxes = [
-            prov.bbox.model_dump_json()  # Or prov.bbox.json() for Pydantic V1
-            for item in meta.doc_items for prov in item.prov
-        ]
-        
         processed_chunks.append({
             "chunk_id": chunk_id,
-            "doc_hash": doc_hash, # Foreign key for Postgres
+            "doc_hash": document_data["doc_hash"], # Foreign key for Postgres
             "chunk_index": i,
             "text": chunk.text,
             "filename": meta.origin.filename,
@@ -127,15 +129,39 @@ def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
             "title": title,
             "content_types": content_types,
             "bounding_boxes": bounding_boxes,
-            "parent_doc_uuid": parent_doc_uuid # The link for Weaviate
         })
-        texts_to_embed.append(chunk.text)
+    return processed_chunks
+
+
+async def embed_chunks_concurrently(processed_chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Embeds a whole document's chunks as concurrent sub-batch requests."""
+    async_client = AsyncEmbeddingServiceClient()
+    try:
+        return await async_client.embed_chunks_concurrently(processed_chunks)
+    finally:
+        await async_client.aclose()
+
+
+def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
+    """
+    Processes chunks and returns a dictionary with:
+    1. A single 'document' object.
+    2. A list of 'chunks' objects.
+    """
+    # We only need the *first* chunk to get the parent doc info
+    if not docling_chunks:
+        return {"document": None, "chunks": []}
+        
+    parent_document_data = build_document_data(docling_chunks[0])
+    
+    print(f"Processing {len(docling_chunks)} chunks for document: {parent_document_data['filename']}")
+    processed_chunks = build_chunk_rows(docling_chunks, parent_document_data)
 
     # --- Batch Embedding using Embedding Service ---
     print(f"Sending {len(processed_chunks)} chunks to embedding service...")
     try:
-        # Call the embedding service API
-        embedded_chunks = embedding_client.embed_chunks(processed_chunks)
+        # Call the embedding service API, sub-batches are sent concurrently
+        embedded_chunks = asyncio.run(embed_chunks_concurrently(processed_chunks))
         
         print("Embeddings generated successfully via embedding service.")
         return {"document": parent_document_data, "chunks": embedded_chunks}
@@ -145,6 +171,79 @@ def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
         return {"document": None, "chunks": []}
 
 
+def stream_ingest(source: Union[str, Path, DocumentStream], batch_size: int = EMBED_BATCH_SIZE) -> int:
+    """
+    Parses, embeds and ingests a PDF one chunk batch at a time.
+
+    A background thread produces chunks into a bounded queue while this thread
+    embeds each full batch and writes it to Postgres and Weaviate, so embedding
+    overlaps with chunking and the whole document is never buffered.
+
+    Returns:
+        int: Number of chunks ingested.
+    """
+    chunk_queue = queue.Queue(maxsize=CHUNK_QUEUE_SIZE)
+    done = object()
+    # Set when ingestion stops early, so the producer stops converting instead of blocking on a full queue
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in iter_chunks(source):
+                if stop.is_set():
+                    break
+                chunk_queue.put(chunk)
+        except Exception as e:
+            chunk_queue.put(e)
+        finally:
+            chunk_queue.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    document_data = None
+    document_inserted = False
+    ingested = 0
+    batch = []
+
+    def flush():
+        nonlocal document_data, document_inserted, ingested
+        if document_data is None:
+            document_data = build_document_data(batch[0])
+        rows = build_chunk_rows(batch, document_data, start_index=ingested)
+        embedded = embedding_client.embed_chunks(rows)
+        # Only once a batch embedded, so a failed upload leaves no orphaned Document
+        if not document_inserted:
+            insert_document(document_data)
+            document_inserted = True
+        ingest_to_postgres(embedded)
+        insert_chunks(document_data["uuid"], embedded)
+        ingested += len(batch)
+        batch.clear()
+
+    finished = False
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is done:
+                finished = True
+                break
+            if isinstance(item, Exception):
+                raise item
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        # On failure, stop the producer and drain the queue so its pending put returns
+        stop.set()
+        while not finished:
+            finished = chunk_queue.get() is done
+
+    print(f"Streamed {ingested} chunks into Postgres and Weaviate.")
+    return ingested
+
+
 # --- 4. EXECUTION (UPDATED) ---
 
 def main():
@@ -0,0 +1,47 @@
+import asyncio
+import random
+
+import pytest
+
+from helpers.text_cleaning import clean_response, clean_stream
+
+SAMPLES = [
+    "Hello **world**, this is   a test.\n\nSecond  paragraph.",
+    "  leading and trailing  \n",
+    "<think>hidden reasoning</think>  The answer is **42**.\n",
+    "# Title\n\n- item _one_\n- item two\t\tend",
+    "before <think>a\nb</think> after <thi not a tag",
+    "مرحبا  **بك**\n\nفي بلتون",
+    "a *\n b {c}  d",
+    "",
+    " \n\t ",
+]
+
+
+def split_randomly(text, rng):
+    cuts = sorted(rng.sample(range(1, len(text)), min(len(text) - 1, rng.randint(0, 8)))) if len(text) > 1 else []
+    bounds = [0, *cuts, len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def run_stream(pieces):
+    async def pieces_iter():
+        for piece in pieces:
+            yield piece
+
+    async def collect():
+        return "".join([text async for text in clean_stream(pieces_iter())])
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_clean_stream_matches_clean_response(text):
+    rng = random.Random(0)
+    for _ in range(200):
+        assert run_stream(split_randomly(text, rng)) == clean_response(text)
+
+
+def test_whitespace_split_across_pieces_collapses_to_one_space():
+    assert run_stream(["foo ", " bar"]) == "foo bar"
+    assert run_stream(["foo\n", "\nbar"]) == "foo bar"
@@ -1,10 +1,14 @@
-import json # <-- ADD THIS IMPORT
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
 from dotenv import load_dotenv
 import os
 import psycopg2
-from psycopg2 import Error
+from psycopg2 import Error, InterfaceError, OperationalError
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from io import StringIO
 import time
+import atexit
+import threading
+from contextlib import contextmanager
 
 
 load_dotenv()
@@ -41,7 +45,12 @@ def get_postgres_connection():
 # --- Run Setup ---
 
 MAX_RETRIES = 10
-RETRY_INTERVAL = 3  # seconds
+RETRY_INTERVAL = 0.5  # seconds, doubled after every failed attempt
+MAX_RETRY_INTERVAL = 8
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff, a restarting server is picked up quickly without hammering a slow one."""
+    return min(RETRY_INTERVAL * 2 ** attempt, MAX_RETRY_INTERVAL)
 
 def wait_for_postgres():
     for attempt in range(MAX_RETRIES):
@@ -59,20 +68,351 @@ def wait_for_postgres():
             return True
         except Exception as e:
             print(f"Connection failed: {e}")
-            time.sleep(RETRY_INTERVAL)
+            time.sleep(retry_delay(attempt))
     print("PostgreSQL not available after multiple attempts.")
     return False
 
+class _ChunkConnection(psycopg2.extensions.connection):
+    """Pooled connection that remembers whether its session has the chunk staging table."""
+    chunk_stage_ready = False
+
+# Connections are reused across ingests, threaded because streamed ingestion runs on worker threads
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 8
+_pool = None
+
+def get_postgres_pool():
+    """Returns the process-wide connection pool, creating it once PostgreSQL is reachable."""
+    global _pool
+    if _pool is None:
+        if not wait_for_postgres():
+            return None
+        _pool = ThreadedConnectionPool(
+            POOL_MIN_CONNECTIONS,
+            POOL_MAX_CONNECTIONS,
+            host=DB_HOST,
+            database=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            port=DB_PORT,
+            connection_factory=_ChunkConnection
+        )
+    return _pool
+
+def close_postgres_pool():
+    """Closes every pooled connection."""
+    if _pool is not None:
+        _pool.closeall()
+
+def release_connection(pool, conn):
+    """Returns a connection to the pool, closing it instead if its session broke."""
+    pool.putconn(conn, close=bool(conn.closed))
+
+# Registered at import so it runs after later exit hooks that still write, like the chunk buffer flush
+atexit.register(close_postgres_pool)
+
+# Cold bulk loads skip per-row B-tree maintenance by dropping these indexes before COPY
+# and rebuilding them once afterwards. Readers lose the indexes meanwhile, so it is opt-in
+DEFER_INDEXES_ON_LOAD = os.getenv("POSTGRES_DEFER_INDEXES", "false").lower() == "true"
+CHUNK_INDEXES = {
+    "idx_chunks_doc_hash": "CREATE INDEX IF NOT EXISTS idx_chunks_doc_hash ON chunks (doc_hash);",
+    "idx_chunks_filename": "CREATE INDEX IF NOT EXISTS idx_chunks_filename ON chunks (filename);",
+}
+
+def _drop_chunk_indexes(conn, cursor):
+    cursor.execute(f"DROP INDEX IF EXISTS {', '.join(CHUNK_INDEXES)};")
+    conn.commit()
+
+def _create_chunk_indexes(conn, cursor):
+    for create_sql in CHUNK_INDEXES.values():
+        cursor.execute(create_sql)
+    conn.commit()
+
+def create_chunk_indexes():
+    """Builds the secondary chunk indexes, e.g. once after a bulk load that ran without them."""
+    pool = get_postgres_pool()
+    if not pool:
+        return
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            print("Rebuilding chunk indexes...")
+            _create_chunk_indexes(conn, cursor)
+    except Error as e:
+        print(f"❌ ERROR: Could not rebuild chunk indexes: {e}")
+        conn.rollback()
+    finally:
+        release_connection(pool, conn)
+
+@contextmanager
+def deferred_chunk_indexes(enabled: bool = DEFER_INDEXES_ON_LOAD):
+    """
+    Drops the secondary chunk indexes for a bulk load and rebuilds them once when it ends.
+    Wrap the whole run of ingests, not each document, so a cold load of many
+    documents builds the indexes a single time.
+    """
+    pool = get_postgres_pool() if enabled else None
+    if not pool:
+        yield
+        return
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cursor:
+            _drop_chunk_indexes(conn, cursor)
+    finally:
+        release_connection(pool, conn)
+    try:
+        yield
+    finally:
+        # Buffered rows are written first so they are covered by the single build
+        CHUNK_BUFFER.flush()
+        create_chunk_indexes()
+
+CHUNK_COLUMNS = (
+    "chunk_id, doc_hash, chunk_index, filename, "
+    "page_numbers, title, text, content_types, bounding_boxes"
+)
+
+def _copy_field(value) -> str:
+    """Encode one value for COPY's text format (NULL as \\N, separators escaped)."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+def _float_array(values) -> str:
+    """Postgres array literal for a float8[] column."""
+    return "{" + ",".join(map(repr, values)) + "}"
+
+def _int_array(values) -> str:
+    """Postgres array literal for an integer[] column."""
+    return "{" + ",".join(map(str, values)) + "}"
+
+def _text_array(values) -> str:
+    """Postgres array literal for a text[] column, every element quoted."""
+    return "{" + ",".join(
+        '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values
+    ) + "}"
+
+# The staging table lives as long as the pooled session and is emptied on every commit,
+# so batches neither create nor drop catalog entries, and the merge is planned once per session
+_SETUP_CHUNK_STAGE_SQL = "CREATE TEMP TABLE IF NOT EXISTS chunks_stage (LIKE chunks INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+_PREPARE_MERGE_SQL = f"""
+    PREPARE merge_chunks_stage AS
+    INSERT INTO chunks ({CHUNK_COLUMNS})
+    SELECT {CHUNK_COLUMNS} FROM chunks_stage
+    ON CONFLICT (chunk_id) DO NOTHING;
+"""
+
+def _prepare_chunk_stage(cursor):
+    """Creates the session's staging table and merge statement on first use of a connection."""
+    conn = cursor.connection
+    if conn.chunk_stage_ready:
+        return
+    cursor.execute(_SETUP_CHUNK_STAGE_SQL)
+    # Committed on its own so a rolled back batch cannot take the table with it
+    conn.commit()
+    cursor.execute(_PREPARE_MERGE_SQL)
+    conn.chunk_stage_ready = True
+
+def _bulk_copy_chunks(cursor, rows: List[tuple]) -> int:
+    """
+    Streams rows into 'chunks' with COPY, skipping chunk_ids that already exist.
+    COPY cannot handle conflicts itself, so the rows go through a temporary staging
+    table that is emptied when the transaction commits.
+    Must run at the start of a transaction on a pooled connection.
+
+    Returns:
+        int: number of rows actually inserted
+    """
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_field(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    _prepare_chunk_stage(cursor)
+    cursor.copy_expert(f"COPY chunks_stage ({CHUNK_COLUMNS}) FROM STDIN", buffer)
+    cursor.execute("EXECUTE merge_chunks_stage;")
+    return cursor.rowcount
+
+def _chunk_rows(data: List[Dict[str, Any]]) -> List[tuple]:
+    """Converts processed chunks into rows ordered like CHUNK_COLUMNS."""
+    return [
+        (
+            str(d["chunk_id"]),
+            d["doc_hash"],
+            d["chunk_index"],
+            d["filename"],
+            _int_array(d["page_numbers"]) if d["page_numbers"] else None,
+            d["title"],
+            d["text"],
+            _text_array(d["content_types"]) if d["content_types"] else None,
+            _float_array(d["bounding_boxes"]) if d["bounding_boxes"] else None,
+        )
+        for d in data
+    ]
+
+# Errors that mean the connection failed, not the rows
+_CONNECTION_ERRORS = (OperationalError, InterfaceError, PoolError)
+
+def _copy_and_commit(conn, rows: List[tuple]) -> int:
+    """COPYs rows in their own transaction on a pooled connection, returning how many were new."""
+    with conn.cursor() as cursor:
+        inserted = _bulk_copy_chunks(cursor, rows)
+    conn.commit()
+    return inserted
+
+class ChunkBuffer:
+    """
+    Collects chunk rows across ingest calls and COPYs them in large batches,
+    so per-document ingests share one transaction instead of opening their own.
+    A background thread flushes every max_wait seconds, or as soon as max_rows are waiting.
+    """
+
+    def __init__(self, max_rows: int = 5000, max_wait: float = 2.0, max_pending_rows: int = 50000):
+        self.max_rows = max_rows
+        self.max_wait = max_wait
+        # Rows from failed flushes are kept for a retry, up to this many in total
+        self.max_pending_rows = max_pending_rows
+        self.rows = []
+        self.lock = threading.Lock()
+        self.rows_ready = threading.Condition(self.lock)
+        # Serializes flushes so the exit flush waits for one already in flight
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+
+    def add(self, data: List[Dict[str, Any]]):
+        """Queues processed chunks for the next flush."""
+        rows = _chunk_rows(data)
+        if not rows:
+            return
+        with self.rows_ready:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._run, daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+            self.rows.extend(rows)
+            if len(self.rows) >= self.max_rows:
+                self.rows_ready.notify()
+
+    def _run(self):
+        while True:
+            with self.rows_ready:
+                self.rows_ready.wait(self.max_wait)
+            # The flusher must outlive any single failure, or queued rows would never be written
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ ERROR: PostgreSQL buffered flush crashed: {e}")
+
+    def _requeue(self, rows: List[tuple], reason: str):
+        """Puts rows from a failed flush back in front of the queue, dropping the oldest beyond max_pending_rows."""
+        with self.lock:
+            self.rows[:0] = rows
+            dropped = len(self.rows) - self.max_pending_rows
+            if dropped > 0:
+                del self.rows[:dropped]
+            pending = len(self.rows)
+        print(f"❌ ERROR: PostgreSQL buffered flush of {len(rows)} chunks failed ({reason}), {pending} chunks kept for retry.")
+        if dropped > 0:
+            print(f"❌ ERROR: Retry buffer full, dropped {dropped} chunks.")
+
+    def flush(self):
+        """Writes every queued row to PostgreSQL in one COPY transaction."""
+        with self.flush_lock:
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return
+
+            try:
+                pool = get_postgres_pool()
+            except Exception as e:
+                self._requeue(rows, str(e))
+                return
+            if not pool:
+                self._requeue(rows, "PostgreSQL unavailable")
+                return
+
+            conn = None
+            try:
+                conn = pool.getconn()
+                conn.autocommit = False
+                try:
+                    inserted = _copy_and_commit(conn, rows)
+                    print(f"PostgreSQL buffered flush successful. {inserted} new rows inserted.")
+                except _CONNECTION_ERRORS:
+                    raise
+                except Error as e:
+                    # One bad row rejects the whole window, so isolate it to the document it belongs to
+                    conn.rollback()
+                    print(f"⚠️ PostgreSQL buffered flush of {len(rows)} chunks was rejected ({e}), retrying per document...")
+                    self._flush_per_document(conn, rows)
+            except _CONNECTION_ERRORS as e:
+                # Connection trouble, the rows are retried on the next flush.
+                # Rows already committed are skipped then, the merge ignores existing chunk_ids
+                self._requeue(rows, str(e))
+                if conn and not conn.closed:
+                    conn.rollback()
+            finally:
+                if conn:
+                    release_connection(pool, conn)
+
+    def _flush_per_document(self, conn, rows: List[tuple]):
+        """Writes the rows one document at a time, dropping only the documents the server rejects."""
+        documents = {}
+        for row in rows:
+            documents.setdefault(row[1], []).append(row)
+
+        inserted = 0
+        lost = []
+        for doc_hash, doc_rows in documents.items():
+            try:
+                inserted += _copy_and_commit(conn, doc_rows)
+            except _CONNECTION_ERRORS:
+                raise
+            except Error as e:
+                # Retrying this document would fail the same way
+                conn.rollback()
+                lost.append(doc_hash)
+                print(f"❌ ERROR: PostgreSQL rejected the {len(doc_rows)} chunks of document {doc_hash} ('{doc_rows[0][3]}'), dropped: {e}")
+        print(f"PostgreSQL per-document flush: {inserted} new rows inserted, {len(lost)} of {len(documents)} documents dropped.")
+        if lost:
+            print(f"❌ ERROR: Documents not written to PostgreSQL, re-ingest them: {', '.join(lost)}")
+
+CHUNK_BUFFER = ChunkBuffer()
+
 # --- INGESTION (REPLACED) ---
 def ingest_to_postgres(data: List[Dict[str, Any]]):
     """
-    Ingests a list of processed chunks into the PostgreSQL database.
+    Queues a list of processed chunks for the PostgreSQL database.
+    Rows are written by CHUNK_BUFFER shortly after, together with other
+    ingests, and any still queued are flushed at exit.
     This function is idempotent and will not create duplicates
     based on the 'chunk_id' primary key.
     """
+    if not data:
+        print("No data provided to ingest.")
+        return
+    CHUNK_BUFFER.add(data)
+
+def ingest_batches_to_postgres(batches: Iterable[Tuple[List[Dict[str, Any]], Any]]):
+    """
+    Ingests (chunks, vectors) batches as they arrive over one connection,
+    committing each batch on its own so rows land while later batches are still embedded.
+    The vectors are not stored in Postgres and are ignored.
+    For a cold bulk load, run the ingests inside deferred_chunk_indexes().
+    """
     
-    # 1. Wait for the database to be ready
-    if not wait_for_postgres():
+    # 1. Wait for the database to be ready (only until the pool exists)
+    pool = get_postgres_pool()
+    if not pool:
         print("Exiting due to failed PostgreSQL connection.")
         return
 
@@ -80,61 +420,37 @@ def ingest_to_postgres(data: List[Dict[str, Any]]):
     cursor = None
     
     try:
-        # 2. Use your helper function to get the connection
-        # (This already sets autocommit=False)
-        conn, cursor = get_postgres_connection()
-        
-        if not conn or not cursor:
-            # get_postgres_connection already printed the error
-            return
+        # 2. Borrow a pooled connection, transactions are committed explicitly
+        conn = pool.getconn()
+        conn.autocommit = False
+        cursor = conn.cursor()
 
-        # 3. Prepare the data for insertion
-        insert_data = [
-            (
-                str(d["chunk_id"]),
-                d["doc_hash"],
-                d["chunk_index"],
-                d["filename"],
-                json.dumps(d["page_numbers"]) if d["page_numbers"] else None,
-                d["title"],
-                d["text"],
-                json.dumps(d["content_types"]) if d["content_types"] else None,
-                json.dumps(d["bounding_boxes"]) if d["bounding_boxes"] else None,
-            )
-            for d in data
-        ]
-        
-        if not insert_data:
-            print("No data provided to ingest.")
-            return
+        total = 0
+        for chunks, _ in batches:
+            # 3. Prepare the data for insertion
+            insert_data = _chunk_rows(chunks)
+            if not insert_data:
+                continue
 
-        # 4. Execute the batch insert as a single transaction
-        print(f"Attempting to ingest {len(insert_data)} chunks into PostgreSQL...")
+            # 4. Execute the batch insert as a single transaction
+            print(f"Attempting to ingest {len(insert_data)} chunks into PostgreSQL...")
+            inserted = _bulk_copy_chunks(cursor, insert_data)
+            
+            # 5. Commit the batch
+            conn.commit()
+            total += inserted
         
-        cursor.executemany("""
-        INSERT INTO chunks (
-            chunk_id, doc_hash, chunk_index, filename, 
-            page_numbers, title, text, content_types, bounding_boxes
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (chunk_id) DO NOTHING;
-        """, insert_data)
-        
-        # 5. Commit the entire transaction
-        conn.commit()
-        
-        # cursor.rowcount shows how many rows were *actually* inserted
-        print(f"PostgreSQL batch insert successful. {cursor.rowcount} new rows inserted.")
+        # Conflicting chunk_ids are skipped, so this counts only new rows
+        print(f"PostgreSQL batch insert successful. {total} new rows inserted.")
 
     except Error as e:
         print(f"❌ ERROR: PostgreSQL transaction failed: {e}")
-        # 6. Roll back the entire batch if anything went wrong
+        # 6. Roll back the current batch if anything went wrong
         if conn:
             conn.rollback()
     finally:
-        # 7. Always close connections
+        # 7. Always return the connection to the pool
         if cursor:
             cursor.close()
         if conn:
-            conn.close()
-        print("PostgreSQL connection closed.")
\ No newline at end of file
+            release_connection(pool, conn)
@@ -0,0 +1,95 @@
+import orjson
+import uuid
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
+
+import numpy as np
+
+# Row fields written next to the vector, in the order build_chunk_rows produces them
+ROW_COLUMNS = (
+    "chunk_id", "doc_hash", "chunk_index", "text", "filename",
+    "page_numbers", "title", "content_types", "bounding_boxes"
+)
+SPOOL_READ_BATCH_SIZE = 500
+# Vectors are spooled at half precision, half the file size of float32 for a negligible recall loss
+SPOOL_VECTOR_DTYPE = np.float16
+
+
+def _spool_schema(dimensions: int, document: Dict[str, str]):
+    """Declared up front so a batch where a column is all None still matches the file."""
+    import pyarrow as pa
+
+    return pa.schema([
+        ("chunk_id", pa.string()),
+        ("doc_hash", pa.string()),
+        ("chunk_index", pa.int64()),
+        ("text", pa.string()),
+        ("filename", pa.string()),
+        ("page_numbers", pa.list_(pa.int64())),
+        ("title", pa.string()),
+        ("content_types", pa.list_(pa.string())),
+        ("bounding_boxes", pa.list_(pa.float64())),
+        ("vector", pa.list_(pa.float16(), dimensions)),
+    ], metadata={"document": orjson.dumps(document)})
+
+
+def _batch_table(chunks_data: List[Dict[str, Any]], vectors: np.ndarray, schema):
+    import pyarrow as pa
+
+    columns = {name: [chunk[name] for chunk in chunks_data] for name in ROW_COLUMNS}
+    columns["chunk_id"] = [str(chunk_id) for chunk_id in columns["chunk_id"]]
+    # One flat half precision buffer viewed as fixed-size lists, no Python float per component
+    flat = pa.array(np.ascontiguousarray(vectors, dtype=SPOOL_VECTOR_DTYPE).reshape(-1))
+    columns["vector"] = pa.FixedSizeListArray.from_arrays(flat, schema.field("vector").type.list_size)
+    return pa.table(columns, schema=schema)
+
+
+def write_batches_to_parquet(parent_doc_data: Dict[str, Any], batches: Iterable[Tuple[List[Dict[str, Any]], Any]], path: str):
+    """
+    Appends each (chunks, vectors) batch to a Parquet file as it arrives,
+    with the parent document stored in the file metadata, so the document can
+    be re-ingested later without embedding it again.
+    """
+    import pyarrow.parquet as pq
+
+    document = {key: str(value) for key, value in parent_doc_data.items()}
+    writer = None
+    total = 0
+    try:
+        for chunks_data, vectors in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(path, _spool_schema(vectors.shape[1], document))
+            writer.write_table(_batch_table(chunks_data, vectors, writer.schema))
+            total += len(chunks_data)
+        print(f"Spooled {total} chunks to '{path}'.")
+    except Exception as e:
+        print(f"ERROR during Parquet spooling: {e}")
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def read_parquet_spool(path: str, batch_size: int = SPOOL_READ_BATCH_SIZE) -> Tuple[Dict[str, Any], Iterator[Tuple[List[Dict[str, Any]], np.ndarray]]]:
+    """
+    Opens a spool written by write_batches_to_parquet.
+
+    Returns:
+        The parent document and a lazy iterator of (chunks, vectors) batches,
+        holding one batch of rows in memory at a time
+    """
+    import pyarrow.parquet as pq
+
+    spool = pq.ParquetFile(path)
+    document = orjson.loads(spool.schema_arrow.metadata[b"document"])
+    document["uuid"] = uuid.UUID(document["uuid"])
+    dimensions = spool.schema_arrow.field("vector").type.list_size
+
+    def batches():
+        for record_batch in spool.iter_batches(batch_size=batch_size):
+            columns = {name: record_batch.column(name).to_pylist() for name in ROW_COLUMNS}
+            chunks_data = [dict(zip(ROW_COLUMNS, values)) for values in zip(*columns.values())]
+            vectors = record_batch.column("vector").flatten().to_numpy().reshape(-1, dimensions)
+            # Back to the float32 the sinks get from a live run
+            vectors = vectors.astype(np.float32)
+            yield chunks_data, vectors
+
+    return document, batches()
@@ -6,19 +6,43 @@ from weaviate.classes.config import (
     ReferenceProperty,
 )
 import weaviate.classes as wvc
+from weaviate.classes.init import AdditionalConfig, Timeout
 
 from weaviate.classes.data import DataObject
 from weaviate.util import generate_uuid5
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Tuple
+from functools import lru_cache
+import atexit
+import os
 
-DOCUMENT_COLLECTION = "IT_Chatbot_Document"
+DOCUMENT_COLLECTION = "Document"
 CHUNK_COLLECTION = "DocChunk"
 
+# Objects per gRPC batch request and how many requests are in flight at once, tunable per cluster
+WEAVIATE_BATCH_SIZE = int(os.getenv("WEAVIATE_BATCH_SIZE", 500))
+WEAVIATE_CONCURRENT_REQUESTS = int(os.getenv("WEAVIATE_CONCURRENT_REQUESTS", min(8, os.cpu_count() or 1)))
+
+# "sq" stores the DocChunk HNSW index as int8 (scalar quantization), about a quarter of the
+# float32 vector memory, with a small recall loss that rescoring mostly recovers. Off by default
+VECTOR_QUANTIZER = os.getenv("WEAVIATE_VECTOR_QUANTIZER", "").lower()
+
+# DocChunk HNSW graph parameters: search candidate list size, build candidate list size and
+# links per node. Higher values trade memory and ingest time for recall; only applied when the collection is created
+HNSW_EF = int(os.getenv("WEAVIATE_HNSW_EF", 64))
+HNSW_EF_CONSTRUCTION = int(os.getenv("WEAVIATE_HNSW_EF_CONSTRUCTION", 128))
+HNSW_MAX_CONNECTIONS = int(os.getenv("WEAVIATE_HNSW_MAX_CONNECTIONS", 32))
+
+# Set once define_schema has run in this process
+_schema_ready = False
+
 def create_client():
     print("Connecting to Weaviate to set up schema...")
 
     try:
-        client = weaviate.connect_to_local()
+        # Large concurrent batches can take longer than the default insert timeout
+        client = weaviate.connect_to_local(
+            additional_config=AdditionalConfig(timeout=Timeout(insert=120))
+        )
         print("Weaviate connection successful.")
         return client
     
@@ -26,14 +50,33 @@ def create_client():
         print(f"ERROR: Could not connect to weaviate: {e}")
 
 
+@lru_cache(maxsize=1)
+def _cached_client():
+    client = create_client()
+    if client:
+        atexit.register(client.close)
+    return client
+
+def get_client():
+    """Returns a process-wide Weaviate client, reconnecting if the cached one is down."""
+    client = _cached_client()
+    if client is None or not client.is_connected():
+        _cached_client.cache_clear()
+        client = _cached_client()
+    return client
+
+
 def define_schema(client: weaviate.WeaviateClient):
     """
     Creates the 'Document' and 'DocChunk' collections in Weaviate.
     """
-    if not client.collections.exists(DOCUMENT_COLLECTION):
+    # One request lists every collection instead of an exists() round-trip per collection
+    existing = client.collections.list_all(simple=True)
+
+    if DOCUMENT_COLLECTION not in existing:
         print("Creating 'Document' collection...")
         client.collections.create(
-            name="Document",
+            name=DOCUMENT_COLLECTION,
             properties=[
                 Property(
                     name="doc_hash", 
@@ -57,10 +100,10 @@ def define_schema(client: weaviate.WeaviateClient):
             vector_config=wvc.config.Configure.Vectors.self_provided()
         )
     
-    if not client.collections.exists(CHUNK_COLLECTION):
+    if CHUNK_COLLECTION not in existing:
         print("Creating 'DocChunk' collection...")
         client.collections.create(
-            name="DocChunk",
+            name=CHUNK_COLLECTION,
             properties=[
                 # --- Content & Metadata ---
                 Property(
@@ -98,7 +141,7 @@ def define_schema(client: weaviate.WeaviateClient):
                     data_type=DataType.TEXT_ARRAY, 
                     tokenization="keyword"
                     ),
-                Property(name="bounding_boxes", data_type=DataType.TEXT_ARRAY), # Storing as JSON strings
+                Property(name="bounding_boxes", data_type=DataType.NUMBER_ARRAY), # Flat [l, t, r, b, ...], 4 numbers per box
                 
                 # --- Foreign Key (for Postgres) ---
                 Property(name="chunk_id", data_type=DataType.UUID, skip_vectorization=True), 
@@ -111,39 +154,72 @@ def define_schema(client: weaviate.WeaviateClient):
             # Tell Weaviate we are providing our own vectors
             vector_config=wvc.config.Configure.Vectors.self_provided(),
             vector_index_config=Configure.VectorIndex.hnsw(
-                distance_metric=weaviate.classes.config.VectorDistances.COSINE
+                distance_metric=weaviate.classes.config.VectorDistances.COSINE,
+                ef=HNSW_EF,
+                ef_construction=HNSW_EF_CONSTRUCTION,
+                max_connections=HNSW_MAX_CONNECTIONS,
+                quantizer=Configure.VectorIndex.Quantizer.sq() if VECTOR_QUANTIZER == "sq" else None
             )
         )
     print("Schema is ready.")
 
 
+def _ready_client():
+    """Returns the shared client, making sure the schema was defined once in this process."""
+    global _schema_ready
+    client = get_client()
+    if client and not _schema_ready:
+        define_schema(client)
+        _schema_ready = True
+    return client
+
+
+def _report_failed_objects(failed_objects) -> int:
+    """Prints the objects Weaviate rejected in the last batch and returns how many there were."""
+    if failed_objects:
+        print(f"ERROR: {len(failed_objects)} objects were rejected by Weaviate, first error: {failed_objects[0].message}")
+    return len(failed_objects)
+
+
 def insert_to_weaviate(ingestion_data: Dict[str, Any]):
     """
     Ingests the parent document and its chunks into Weaviate (v4 syntax),
     creating a graph link between them.
     """
-    client = None
-    try:
-        # --- 1. Connect and ensure schema ---
-        client = weaviate.connect_to_local() 
-        define_schema(client) 
+    parent_doc_data = ingestion_data.get("document")
+    chunks_data = ingestion_data.get("chunks")
+    vectors = ingestion_data.get("vectors")
+
+    if not parent_doc_data or not chunks_data or vectors is None:
+        print("ERROR: Ingestion data is missing 'document', 'chunks' or 'vectors'.")
+        return
+
+    insert_batches_to_weaviate(parent_doc_data, [(chunks_data, vectors)])
 
-        parent_doc_data = ingestion_data.get("document")
-        chunks_data = ingestion_data.get("chunks")
 
-        if not parent_doc_data or not chunks_data:
-            print("ERROR: Ingestion data is missing 'document' or 'chunks'.")
+def insert_batches_to_weaviate(parent_doc_data: Dict[str, Any], batches: Iterable[Tuple[List[Dict[str, Any]], Any]]):
+    """
+    Ingests the parent document and streams (chunks, vectors) batches into
+    the same open Weaviate batch as they arrive, each chunk linked to the document.
+    """
+    try:
+        # --- 1. Shared client, the schema is ensured once per process ---
+        client = _ready_client()
+        if not client:
             return
 
         parent_doc_uuid = parent_doc_data["uuid"]
+        total = 0
 
-        # --- 3. Insert Parent Document Node (v4 syntax) ---
-        print(f"Ingesting 'Document' node: {parent_doc_data['filename']}")
-        document_collection = client.collections.get("Document")
-        
-        try:
-            # v4 syntax for inserting a single object
-            document_collection.data.insert(
+        # --- 3. One client-level batch carries the Document node and its chunks (v4 syntax) ---
+        with client.batch.fixed_size(
+            batch_size=WEAVIATE_BATCH_SIZE,
+            concurrent_requests=WEAVIATE_CONCURRENT_REQUESTS
+        ) as batch:
+            # The stable document UUID makes a re-ingest overwrite the node instead of duplicating it
+            print(f"Ingesting 'Document' node: {parent_doc_data['filename']}")
+            batch.add_object(
+                collection="Document",
                 properties={
                     "doc_hash": parent_doc_data["doc_hash"],
                     "filename": parent_doc_data["filename"],
@@ -151,44 +227,31 @@ def insert_to_weaviate(ingestion_data: Dict[str, Any]):
                 },
                 uuid=parent_doc_uuid
             )
-        except Exception as e:
-            if "already exists" in str(e):
-                print(f"Document node {parent_doc_uuid} already exists. Skipping.")
-            else:
-                raise e
-
-        # --- 4. Prepare & Batch Insert Chunks (v4 syntax) ---
-        print(f"Preparing {len(chunks_data)} chunks for batch ingestion...")
-        
-        chunk_collection = client.collections.get("DocChunk")
-        
-        # v4 syntax for batch writing
-        with chunk_collection.batch.fixed_size(batch_size=100) as batch:
-            for chunk_props in chunks_data:
-                
-                vector = chunk_props.pop("vector", None)
-                if vector is None:
-                    print(f"Warning: Chunk {chunk_props['chunk_index']} has no vector. Skipping.")
-                    continue
-                
-                # This UUID is for the Postgres link, remove it for Weaviate properties
-                chunk_props.pop("parent_doc_uuid", None) 
-                
-                # Add object to batch with properties, vector, and reference
-                batch.add_object(
-                    properties=chunk_props,
-                    vector=vector,
-                    # v4 syntax for adding a cross-reference:
-                    references={
-                        "fromDocument": parent_doc_uuid
-                    }
-                )
-        
-        print(f"Successfully ingested {len(chunks_data)} chunks linked to document.")
+
+            # --- 4. Batch Insert Chunks as they arrive ---
+            for chunks_data, vectors in batches:
+                print(f"Queueing {len(chunks_data)} chunks for batch ingestion...")
+                # Rows of the float32 matrix go to the client as-is, without building Python lists
+                for chunk_props, vector in zip(chunks_data, vectors):
+                    # The rows hold only chunk properties, so they are passed without a per-chunk copy
+                    # Add object to batch with properties, vector, and reference
+                    batch.add_object(
+                        collection="DocChunk",
+                        properties=chunk_props,
+                        vector=vector,
+                        # Same id as the Postgres row, no mapping needed between the stores
+                        uuid=chunk_props["chunk_id"],
+                        # v4 syntax for adding a cross-reference:
+                        references={
+                            "fromDocument": parent_doc_uuid
+                        }
+                    )
+                total += len(chunks_data)
+
+        # Objects still in flight are only sent when the context exits, so the failures
+        # are read right after it, before another batch on this client resets them
+        failed = _report_failed_objects(list(client.batch.failed_objects))
+        print(f"Successfully ingested {total - failed} of {total} chunks linked to document.")
 
     except Exception as e:
-        print(f"ERROR during Weaviate ingestion: {e}")
-    finally:
-        if client:
-            client.close()
-            print("Weaviate connection closed.")
\ No newline at end of file
+        print(f"ERROR during Weaviate ingestion: {e}")
\ No newline at end of file
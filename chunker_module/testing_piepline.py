@@ -1,9 +1,14 @@
 import uuid
-from typing import List, Dict, Any
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
+from itertools import chain, islice
+from typing import List, Dict, Any, Callable, Iterable, Iterator
 
 # # Your helper functions are now imported
-from helpers.DB import ingest_to_postgres
-from helpers.vector_db import insert_to_weaviate
+from helpers.DB import ingest_to_postgres, ingest_batches_to_postgres, deferred_chunk_indexes
+from helpers.vector_db import insert_to_weaviate, insert_batches_to_weaviate
+from helpers.chunk_spool import write_batches_to_parquet, read_parquet_spool
 
 # CHUNKING
 from docling.chunking import HybridChunker
@@ -20,7 +25,11 @@ from docling.datamodel.pipeline_options import (
 from docling.datamodel.settings import settings
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from sentence_transformers import SentenceTransformer # <-- ADD THIS
+from transformers import AutoTokenizer
 import torch
+import numpy as np
+import math
+import atexit
 
 # --- 1. SETUP ---
 load_dotenv()
@@ -34,26 +43,119 @@ pipeline_options.do_ocr = True
 pipeline_options.do_table_structure = True
 pipeline_options.table_structure_options.do_cell_matching = True
 
-converter = DocumentConverter(
-    format_options={
-        InputFormat.PDF: PdfFormatOption(
-            pipeline_options=pipeline_options,
-        )
-    }
-)
+@lru_cache(maxsize=1)
+def get_converter() -> DocumentConverter:
+    """Builds the docling converter on first use, so importing this module stays cheap."""
+    return DocumentConverter(
+        format_options={
+            InputFormat.PDF: PdfFormatOption(
+                pipeline_options=pipeline_options,
+            )
+        }
+    )
+
 EMBEDDING_MODEL = "BAAI/bge-m3" 
+# bge-m3 accepts 8192 tokens; clamping keeps one long outlier from padding a whole batch.
+# The chunker uses the same limit, so no chunk is truncated
+MAX_SEQ_LENGTH = 512
+EMBED_BATCH_SIZE = 64
+
+# "onnx" runs CPU inference through ONNX Runtime's fused graph, "torch" the PyTorch model.
+# GPUs always use the torch model in half precision
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+# Runs the torch CPU model in bfloat16, only worth it on CPUs with native BF16 (AVX512-BF16, AMX)
+EMBEDDING_CPU_BF16 = os.getenv("EMBEDDING_CPU_BF16", "false").lower() == "true"
+
+def onnx_session_options():
+    """ONNX Runtime session options with all graph optimizations and every CPU core."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = os.cpu_count() or 1
+    return options
+
+def load_embedding_model(device: str) -> SentenceTransformer:
+    """Loads the embedding model for the device, falling back to torch if ONNX fails."""
+    if device == "cuda":
+        model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+        # Half precision doubles tensor-core throughput with negligible embedding drift
+        model.half()
+        torch.backends.cuda.matmul.allow_tf32 = True
+        return model
+
+    if EMBEDDING_BACKEND == "onnx":
+        try:
+            # Exports the model to ONNX on first use if the hub has no ONNX weights
+            return SentenceTransformer(
+                EMBEDDING_MODEL,
+                device=device,
+                backend="onnx",
+                model_kwargs={"provider": "CPUExecutionProvider", "session_options": onnx_session_options()}
+            )
+        except Exception as e:
+            print(f"WARNING: ONNX backend unavailable, using torch: {e}")
+    model = SentenceTransformer(EMBEDDING_MODEL, device=device)
+    if EMBEDDING_CPU_BF16:
+        model.to(torch.bfloat16)
+    return model
+
+# Number of worker processes for CPU encoding with the torch backend, 0 disables the pool.
+# ONNX Runtime already spreads one encode across every core, so it does not use the pool
+EMBED_PROCESSES = int(os.getenv("EMBED_PROCESSES", 0))
+encode_pool = None
+
+def get_encode_pool():
+    """Starts the multi-process encode pool once, each worker with its share of the cores."""
+    global encode_pool
+    if encode_pool is None:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // EMBED_PROCESSES))
+        embedding_model = get_embedding_model()
+        encode_pool = embedding_model.start_multi_process_pool(target_devices=["cpu"] * EMBED_PROCESSES)
+        atexit.register(embedding_model.stop_multi_process_pool, encode_pool)
+    return encode_pool
+
+def encode_texts(texts: List[str]) -> np.ndarray:
+    """Encodes texts with the loaded model, sharded over the process pool when enabled."""
+    embedding_model = get_embedding_model()
+    if EMBED_PROCESSES > 1 and device == "cpu" and embedding_model.backend == "torch":
+        return embedding_model.encode_multi_process(
+            texts,
+            get_encode_pool(),
+            batch_size=EMBED_BATCH_SIZE,
+            chunk_size=max(1, math.ceil(len(texts) / EMBED_PROCESSES / 10)),
+            normalize_embeddings=True
+        )
+    with torch.inference_mode():
+        return embedding_model.encode(
+            texts,
+            batch_size=EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            # Called once per streamed batch, a bar per call would only clutter the log
+            show_progress_bar=False
+        )
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # --- Load the local embedding model ---
-# This will download the model the first time it's run
-print(f"Loading embedding model: '{EMBEDDING_MODEL}'...")
-try:
-    device = "cpu" if torch.cuda.is_available() else "cpu"
-    embedding_model = SentenceTransformer("BAAI/bge-m3", device=device)
-    print("Embedding model loaded successfully.")
-except Exception as e:
-    print(f"ERROR: Could not load SentenceTransformer model: {e}")
-    # In a real app, you'd exit here
-    
+@lru_cache(maxsize=1)
+def get_embedding_model() -> SentenceTransformer:
+    """
+    Loads the embedding model once, on first use rather than at import,
+    so helpers like replay_spool can be used without the ~2 GB of weights.
+    This will download the model the first time it's run.
+    """
+    print(f"Loading embedding model: '{EMBEDDING_MODEL}'...")
+    try:
+        embedding_model = load_embedding_model(device)
+        embedding_model.max_seq_length = MAX_SEQ_LENGTH
+        print("Embedding model loaded successfully.")
+        return embedding_model
+    except Exception as e:
+        print(f"ERROR: Could not load SentenceTransformer model: {e}")
+        raise
+
 
 PDF_PATH = "/home/youssef/github/Modular_RAG/PDFs/1H2025_Earnings_Release.pdf"
 
@@ -61,97 +163,123 @@ PDF_PATH = "/home/youssef/github/Modular_RAG/PDFs/1H2025_Earnings_Release.pdf"
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # --- 2. DOCUMENT CONVERSION & CHUNKING ---
-def data_extractions(pdf_path:str) -> any:
+def data_extractions(pdf_path:str) -> Iterator[Any]:
     print(f"Starting conversion for: {pdf_path}")
-    result = converter.convert(pdf_path)
+    result = get_converter().convert(pdf_path)
     print("Document conversion complete.")
 
     chunker = HybridChunker(
-        tokenizer=embedding_model.tokenizer,           # <-- 2. Use the model's tokenizer
-        max_tokens=embedding_model.max_seq_length,   # <-- 3. Use the model's max length
+        # Same vocabulary as the model, but its own instance: chunks are drawn on a prefetch
+        # thread while the model encodes, and a fast tokenizer must not be shared across threads
+        tokenizer=AutoTokenizer.from_pretrained(EMBEDDING_MODEL),
+        max_tokens=MAX_SEQ_LENGTH,   # <-- 3. Use the model's max length
         merge_peers=True,
     )
 
-    chunk_iter = chunker.chunk(dl_doc=result.document)
-    chunks = list(chunk_iter)
-    print(f"Document chunking complete. Found {len(chunks)} chunks.")
-    return chunks
+    # Chunks are produced lazily, so embedding starts before the whole document is chunked
+    return chunker.chunk(dl_doc=result.document)
 
 
 # --- 3. DATA PROCESSING & EMBEDDING  ---
-def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
-    """
-    Processes chunks and returns a dictionary with:
-    1. A single 'document' object.
-    2. A list of 'chunks' objects.
-    """
-    processed_chunks = []
-    texts_to_embed = []
-    
-    # We only need the *first* chunk to get the parent doc info
-    if not docling_chunks:
-        return {"document": None, "chunks": []}
-        
-    first_meta = docling_chunks[0].meta
+def build_parent_document(first_meta: Any) -> Dict[str, Any]:
+    """Builds the parent 'document' object from the metadata of the document's first chunk."""
     doc_hash = str(first_meta.origin.binary_hash)
     
     # Use the hash to create a stable UUID for the parent Document
     parent_doc_uuid = uuid.uuid5(uuid.NAMESPACE_DNS, doc_hash)
 
-    parent_document_data = {
+    return {
         "doc_hash": doc_hash,
         "filename": first_meta.origin.filename,
         "mimetype": first_meta.origin.mimetype,
         "uuid": parent_doc_uuid
     }
-    
-    print(f"Processing {len(docling_chunks)} chunks for document: {first_meta.origin.filename}")
 
-    for i, chunk in enumerate(docling_chunks):
+
+def build_chunk_rows(docling_chunks: List[Any], parent_document_data: Dict[str, Any], start_index: int = 0) -> List[Dict[str, Any]]:
+    """
+    Extracts the metadata of each chunk, numbering them from start_index.
+    The parent document's uuid is not repeated per row, every sink receives the document.
+    """
+    processed_chunks = []
+    doc_hash = parent_document_data["doc_hash"]
+    # Every chunk comes from the same document, so its filename is read once
+    filename = parent_document_data["filename"]
+
+    for i, chunk in enumerate(docling_chunks, start=start_index):
         chunk_id = uuid.uuid4() # This is the Postgres Primary Key
         meta = chunk.meta
+        doc_items = meta.doc_items
+        headings = meta.headings
         
         # --- Extract Rich Metadata ---
-        page_nos = list(sorted(set(
-            prov.page_no for item in meta.doc_items for prov in item.prov
-        )))
+        # One pass over the doc items fills the page numbers, content types and bboxes together
+        page_no_set, content_type_set, bounding_boxes = set(), set(), []
+        for item in doc_items:
+            content_type_set.add(item.label.name.lower())
+            for prov in item.prov:
+                page_no_set.add(prov.page_no)
+                bbox = prov.bbox
+                # Store bboxes as one flat number list, [l, t, r, b] per provenance box
+                bounding_boxes.extend((bbox.l, bbox.t, bbox.r, bbox.b))
+        page_nos = sorted(page_no_set)
+        content_types = list(content_type_set)
         
-        title = meta.headings[0] if meta.headings else None
-        
-        content_types = list(set(
-            item.label.name.lower() for item in meta.doc_items
-        ))
-
-        # Store bboxes as a list of JSON strings
-        bounding_boxes = [
-            prov.bbox.model_dump_json()  # Or prov.bbox.json() for Pydantic V1
-            for item in meta.doc_items for prov in item.prov
-        ]
+        title = headings[0] if headings else None
         
         processed_chunks.append({
             "chunk_id": chunk_id,
             "doc_hash": doc_hash, # Foreign key for Postgres
             "chunk_index": i,
             "text": chunk.text,
-            "filename": meta.origin.filename,
+            "filename": filename,
             "page_numbers": page_nos,
             "title": title,
             "content_types": content_types,
             "bounding_boxes": bounding_boxes,
-            "parent_doc_uuid": parent_doc_uuid # The link for Weaviate
         })
-        texts_to_embed.append(chunk.text)
+    return processed_chunks
+
+
+def embed_chunk_texts(texts_to_embed: List[str]) -> np.ndarray:
+    """Embeds the texts into a float32 matrix, one row per text in the input order."""
+    # Repeated boilerplate (headers, footers, disclaimers) is encoded once and scattered back
+    unique_index = {}
+    positions = [unique_index.setdefault(text, len(unique_index)) for text in texts_to_embed]
+    unique_texts = list(unique_index)
+
+    # Sort by length so each batch pads only to similar lengths, then restore the order
+    order = np.argsort([len(text) for text in unique_texts])
+    sorted_embeddings = encode_texts([unique_texts[i] for i in order])
+    unique_embeddings = sorted_embeddings[np.argsort(order)]
+    # Vectors come back in the model's dtype (float16 on GPU), store them as float32
+    return unique_embeddings[positions].astype(np.float32, copy=False)
+
+
+def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
+    """
+    Processes chunks and returns a dictionary with:
+    1. A single 'document' object.
+    2. A list of 'chunks' objects.
+    3. A float32 'vectors' matrix with one row per chunk.
+    """
+    # We only need the *first* chunk to get the parent doc info
+    if not docling_chunks:
+        return {"document": None, "chunks": []}
+        
+    parent_document_data = build_parent_document(docling_chunks[0].meta)
+    
+    print(f"Processing {len(docling_chunks)} chunks for document: {parent_document_data['filename']}")
+    processed_chunks = build_chunk_rows(docling_chunks, parent_document_data)
 
     # --- Batch Embedding ---
-    print(f"Generating embeddings for {len(texts_to_embed)} chunks...")
+    print(f"Generating embeddings for {len(processed_chunks)} chunks...")
     try:
-        # Call the local model's .encode() method
-        for i, data in enumerate(processed_chunks):
-            vector = embedding_model.encode(data['text'], normalize_embeddings=True).tolist()
-            data["vector"] = vector
+        embeddings = embed_chunk_texts([data["text"] for data in processed_chunks])
             
         print("Embeddings generated successfully.")
-        return {"document": parent_document_data, "chunks": processed_chunks}
+        # Row i of 'vectors' is the embedding of chunks[i], kept as one contiguous matrix
+        return {"document": parent_document_data, "chunks": processed_chunks, "vectors": embeddings}
 
     except Exception as e:
         print(f"ERROR: Failed to generate embeddings: {e}")
@@ -159,31 +287,130 @@ def process_and_embed_chunks(docling_chunks: List[Any]) -> Dict[str, Any]:
         return {"document": None, "chunks": []}
 
 
+# Chunks embedded per streamed batch, several encode batches so length sorting still pays off
+STREAM_BATCH_SIZE = EMBED_BATCH_SIZE * 4
+# Batches waiting per consumer, bounds memory to a few batches instead of the whole document
+STREAM_QUEUE_SIZE = 4
+# Parquet file the embedded batches are also written to, unset to skip spooling
+CHUNK_SPOOL_PATH = os.getenv("CHUNK_SPOOL_PATH")
+
+def _next_chunk_rows(chunk_iter: Iterator[Any], parent_document_data: Dict[str, Any], start: int) -> List[Dict[str, Any]]:
+    """Draws the next STREAM_BATCH_SIZE chunks and extracts their metadata, empty once the chunks run out."""
+    batch = list(islice(chunk_iter, STREAM_BATCH_SIZE))
+    return build_chunk_rows(batch, parent_document_data, start_index=start)
+
+
+def iter_embedded_batches(docling_chunks: Iterable[Any], parent_document_data: Dict[str, Any]):
+    """
+    Yields (chunks, vectors) per STREAM_BATCH_SIZE chunks.
+    The next batch is chunked and its metadata extracted on a background thread
+    while the current one is encoded, the model releases the GIL during inference.
+    """
+    chunk_iter = iter(docling_chunks)
+    start = 0
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = prefetcher.submit(_next_chunk_rows, chunk_iter, parent_document_data, start)
+        while processed_chunks := pending.result():
+            start += len(processed_chunks)
+            pending = prefetcher.submit(_next_chunk_rows, chunk_iter, parent_document_data, start)
+            yield processed_chunks, embed_chunk_texts([data["text"] for data in processed_chunks])
+
+
+def _consume(sink: Callable[[Iterable], None], batch_queue: queue.Queue):
+    """Feeds the queued batches to sink, then drains the queue so the producer never blocks on a failed sink."""
+    finished = False
+
+    def batches():
+        nonlocal finished
+        while (batch := batch_queue.get()) is not None:
+            yield batch
+        finished = True
+
+    try:
+        sink(batches())
+    finally:
+        while not finished:
+            finished = batch_queue.get() is None
+
+
+def stream_ingest(docling_chunks: Iterable[Any], sinks: List[Callable[[Dict[str, Any], Iterable], None]]):
+    """
+    Embeds the chunks batch by batch and hands every batch to each sink on its own thread,
+    so the databases ingest earlier batches while later ones are still being embedded.
+    Each sink is called as sink(document, batches) and consumes the (chunks, vectors) batches.
+    docling_chunks may be a lazy iterator, it is consumed once.
+    """
+    chunk_iter = iter(docling_chunks)
+    first_chunk = next(chunk_iter, None)
+    if first_chunk is None:
+        print("No chunks to ingest.")
+        return
+
+    parent_document_data = build_parent_document(first_chunk.meta)
+    print(f"Streaming chunks for document: {parent_document_data['filename']}")
+    chunk_iter = chain([first_chunk], chunk_iter)
+
+    _fan_out(parent_document_data, iter_embedded_batches(chunk_iter, parent_document_data), sinks)
+
+
+def replay_spool(path: str, sinks: List[Callable[[Dict[str, Any], Iterable], None]]):
+    """Feeds a document spooled to Parquet into the sinks, without converting or embedding it again."""
+    parent_document_data, batches = read_parquet_spool(path)
+    print(f"Replaying spooled chunks for document: {parent_document_data['filename']}")
+    _fan_out(parent_document_data, batches, sinks)
+
+
+def _fan_out(parent_document_data: Dict[str, Any], batches: Iterable, sinks: List[Callable[[Dict[str, Any], Iterable], None]]):
+    """
+    Hands every batch to each sink through its own bounded queue and thread.
+    If producing the batches fails, the sinks still finish with what they received,
+    then the error is raised so the caller knows the document is incomplete.
+    """
+    queues = [queue.Queue(maxsize=STREAM_QUEUE_SIZE) for _ in sinks]
+    producer_error = None
+    with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+        futures = [
+            executor.submit(_consume, partial(sink, parent_document_data), batch_queue)
+            for sink, batch_queue in zip(sinks, queues)
+        ]
+        try:
+            for batch in batches:
+                for batch_queue in queues:
+                    batch_queue.put(batch)
+        except Exception as e:
+            print(f"ERROR: Failed to produce chunk batches: {e}")
+            producer_error = e
+        finally:
+            for batch_queue in queues:
+                batch_queue.put(None)
+        for future in futures:
+            future.result()
+    if producer_error is not None:
+        raise producer_error
+
+
 # --- 4. EXECUTION (UPDATED) ---
 
 def main():
+    # Lazy chunk iterator, stream_ingest reports an empty document
     chunks = data_extractions(PDF_PATH)
-    
-    if not chunks:
-        print("No chunks were generated. Exiting.")
-        return
 
-    # 1. Process docling chunks and get embeddings
-    ingestion_data = process_and_embed_chunks(docling_chunks=chunks)
-    
-    if not ingestion_data["chunks"]:
-        print("Data processing or embedding failed. Exiting.")
-        return
-
-    # 2. Ingest into databases
-    # Pass only the list of chunks to Postgres
-    # ingest_to_postgres(ingestion_data["chunks"]) 
-    
-    # # Pass the full dictionary to Weaviate to build the graph
-    insert_to_weaviate(ingestion_data)
+    # Embed and ingest in streamed batches
+    sinks = [
+        # Postgres takes only the chunks
+        # lambda document, batches: ingest_batches_to_postgres(batches),
+        # Weaviate also gets the document to build the graph
+        insert_batches_to_weaviate,
+    ]
+    if CHUNK_SPOOL_PATH:
+        # Keeps the embedded document on disk so it can be re-ingested with replay_spool
+        sinks.append(partial(write_batches_to_parquet, path=CHUNK_SPOOL_PATH))
+    # With POSTGRES_DEFER_INDEXES=true the chunk indexes are dropped once for the run and rebuilt at its end
+    with deferred_chunk_indexes():
+        stream_ingest(chunks, sinks)
     
     # print("\n--- Ingestion Complete ---")
-    # print(f"Successfully processed and ingested {len(ingestion_data['chunks'])} chunks.")
+    # print("Successfully processed and ingested all chunks.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,18 +1,24 @@
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.messages import get_buffer_string
 import os
 from dotenv import load_dotenv
 import re
-from typing import Dict
-from langdetect import detect
+import asyncio
+import httpx
+import time
+import threading
+from typing import AsyncIterator, Dict, Tuple
+from collections import OrderedDict
 
 # ==================================================================================
 # comment this use it without docker
 from helpers.date_agent import DateAgent
 from helpers.langsmith_config import setup_langsmith
-from helpers.retrieval import get_rag_context
+from helpers.retrieval import get_rag_context, warmup as warmup_retrieval
+from helpers.text_cleaning import clean_response, clean_stream
 
 # uncomment this use it without docker
 # from helpers.date_agent import DateAgent
@@ -31,15 +37,69 @@ setup_langsmith()
 
 # -- LLM and prompt setup --
 openai_api_key = os.getenv("OPENAI_API_KEY")
+# One keep-alive HTTP/2 pool for every OpenAI request, so turns reuse open TLS connections
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=100, max_connections=200)
+)
 llm = ChatOpenAI(
     model="gpt-4o-mini",
     temperature=0.5,
-    openai_api_key=openai_api_key
+    openai_api_key=openai_api_key,
+    http_async_client=openai_http_client
 )
 
-# In-memory store for user chat chains
-chat_chains: Dict[str, LLMChain] = {}
-MAX_TOKEN_LIMIT = 500
+# In-memory store for user chat chains, bounded so idle users do not accumulate forever.
+# Format: {user_id: (chain, last_access_timestamp)}, least recently used first
+MAX_CHAINS = int(os.getenv("MAX_CHAINS", 1000))
+CHAIN_TTL_SECONDS = int(os.getenv("CHAIN_TTL_SECONDS", 3600))  # Idle time after which a conversation starts over
+chat_chains: "OrderedDict[str, Tuple[LLMChain, float]]" = OrderedDict()
+chat_chains_lock = threading.Lock()
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", 3))  # Question/answer pairs kept in memory
+# Follow-up detection only needs the previous question and answer, not the whole window
+CLASSIFIER_HISTORY_MESSAGES = 2
+
+# Results of the auxiliary LLM calls (query rewrite, follow-up classification), least recently used first.
+# A repeated question skips the round-trip; the CLI runs on one event loop, so no lock is needed
+LLM_CACHE_SIZE = 2048
+search_query_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+question_type_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+
+def normalize_question(question: str) -> str:
+    """Cache key form of a question: case and whitespace differences do not change the answer."""
+    return " ".join(question.split()).lower()
+
+
+def cache_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def cache_put(cache: OrderedDict, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > LLM_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+# Auxiliary LLM calls currently running, by prompt. Concurrent turns that send the very
+# same prompt (the same question from several users) wait on one request instead of each sending it
+inflight_llm_calls: Dict[str, asyncio.Task] = {}
+
+
+async def ainvoke_coalesced(prompt: str) -> str:
+    """Runs an auxiliary prompt and returns its stripped text, joining an identical call already in flight."""
+    task = inflight_llm_calls.get(prompt)
+    if task is None:
+        task = asyncio.ensure_future(llm.ainvoke(prompt))
+        inflight_llm_calls[prompt] = task
+        task.add_done_callback(lambda _: inflight_llm_calls.pop(prompt, None))
+    # Shielded, so one waiter being cancelled does not cancel the request for the others
+    return (await asyncio.shield(task)).content.strip()
 
 # -- English Prompt template --
 english_template_str = """
@@ -120,55 +180,57 @@ def get_or_create_conversation_chain(user_id: str, lang: str) -> LLMChain:
     Returns:
         LLMChain: The conversation chain associated with the user and language.
     """
-    if user_id not in chat_chains:
+    current_time = time.time()
+    with chat_chains_lock:
+        entry = chat_chains.get(user_id)
+        if entry and current_time - entry[1] < CHAIN_TTL_SECONDS:
+            chat_chains[user_id] = (entry[0], current_time)
+            chat_chains.move_to_end(user_id)
+            return entry[0]
+
         print(f"🧠 Creating new LLM chain for user '{user_id}' in '{lang}'.")
-        memory = ConversationSummaryBufferMemory(
-            llm=llm,
-            max_token_limit=MAX_TOKEN_LIMIT,
+        # A fixed window keeps the history bounded without a summarization LLM call once it grows
+        memory = ConversationBufferWindowMemory(
+            k=HISTORY_WINDOW_TURNS,
             memory_key="history",
             input_key="input",
             return_messages=False
         )
-        prompt_template = arabic_prompt if lang == "ar" else english_prompt
-        chat_chains[user_id] = LLMChain(
+        new_chain = LLMChain(
             llm=llm,
             memory=memory,
-            prompt=prompt_template,
+            prompt=LANG_CONFIG[lang]["chat_prompt"],
             verbose=True
         )
-    return chat_chains[user_id]
+        chat_chains[user_id] = (new_chain, current_time)
+        chat_chains.move_to_end(user_id)
+        # Drop the least recently used conversations beyond the limit
+        while len(chat_chains) > MAX_CHAINS:
+            chat_chains.popitem(last=False)
+        return new_chain
 
 
-def detect_language(text):
-    if detect(text) == 'ar':
-        return "ar"
-    else:
-        return "en"
+ARABIC_CHAR_PATTERN = re.compile(r"[\u0600-\u06FF\u0750-\u077F]")
+LETTER_PATTERN = re.compile(r"[^\W\d_]")
 
+def detect_language(text):
+    # Only Arabic vs English matters here: Arabic if at least a third of the letters
+    # are Arabic script, so Arabic questions that mention English names stay Arabic
+    arabic = len(ARABIC_CHAR_PATTERN.findall(text))
+    return "ar" if arabic and arabic * 3 >= len(LETTER_PATTERN.findall(text)) else "en"
 
-def get_search_query(question: str, lang: str) -> str:
-    """Generates an optimized search query based on the input question and language.
-    
-    Args:
-        question (str): The user's question.
-        lang (str): The language code ('ar' for Arabic, 'en' for English).
 
-    Returns:
-        str: The optimized search query.
-    """
-    search_query = question
-    if lang == "ar":
-        arabic_search_prompt = f"""
+# -- Query rewrite prompts --
+# Built once at import; the question comes last, so every rewrite shares the same static prefix
+ARABIC_SEARCH_PROMPT = """
         صِغ الاستعلام العربي التالي ليكون استعلامًا واضحًا ومختصرًا ومناسبًا لاسترجاع المعلومات.
         - لا تضف كلمات إضافية غير ضرورية.
         - إذا كان يحتوي على اختصار (مثل CEO, CFO, CTO ...) قم بتوسيعه بالاسم الكامل باللغة الإنجليزية.
         
         الاستعلام: {question}
         """
-        search_query = llm.invoke(arabic_search_prompt).content.strip()
-        print(f"🌍 الاستعلام العربي → المحسن: '{question}' → '{search_query}'")
-    else:
-        english_search_prompt = f"""
+
+ENGLISH_SEARCH_PROMPT = """
         Rewrite the following English user query into a clear, concise query suitable for information retrieval.
 
         If the query contains acronyms like CEO, CTO, COO, expand them to their full forms and keep both (e.g., CEO → CEO (Chief Executive Officer)).
@@ -180,12 +242,66 @@ def get_search_query(question: str, lang: str) -> str:
 
         Query: {question}
         """
-        search_query = llm.invoke(english_search_prompt).content.strip()
-        print(f"✍ Optimized English Query: '{question}' → '{search_query}'")
+
+# Everything that differs per language, looked up once per call; a new language only needs an entry here
+LANG_CONFIG = {
+    "ar": {
+        "chat_prompt": arabic_prompt,
+        "search_prompt": ARABIC_SEARCH_PROMPT,
+        "search_log": "🌍 الاستعلام العربي → المحسن: '{}' → '{}'",
+    },
+    "en": {
+        "chat_prompt": english_prompt,
+        "search_prompt": ENGLISH_SEARCH_PROMPT,
+        "search_log": "✍ Optimized English Query: '{}' → '{}'",
+    },
+}
+
+# Short questions with nothing for the rewrite rules to act on (acronyms, roles) are searched as asked
+SIMPLE_QUERY_MAX_WORDS = 8
+ACRONYM_PATTERN = re.compile(r"\b[A-Z]{2,}\b")
+ROLE_PATTERN = re.compile(
+    r"\b(ceo|cfo|cto|coo|chairman|president|director|manager)\b",
+    re.IGNORECASE
+)
+
+
+def is_simple_query(question: str) -> bool:
+    """True when rewriting the question would most likely return it unchanged."""
+    return (
+        len(question.split()) < SIMPLE_QUERY_MAX_WORDS
+        and ACRONYM_PATTERN.search(question) is None
+        and ROLE_PATTERN.search(question) is None
+    )
+
+
+async def get_search_query(question: str, lang: str) -> str:
+    """Generates an optimized search query based on the input question and language.
+    
+    Args:
+        question (str): The user's question.
+        lang (str): The language code ('ar' for Arabic, 'en' for English).
+
+    Returns:
+        str: The optimized search query.
+    """
+    if is_simple_query(question):
+        return question
+
+    cache_key = (normalize_question(question), lang)
+    cached = cache_get(search_query_cache, cache_key)
+    if cached is not None:
+        print(f"♻️ Reusing rewritten query: '{question}' → '{cached}'")
+        return cached
+
+    cfg = LANG_CONFIG[lang]
+    search_query = await ainvoke_coalesced(cfg["search_prompt"].format(question=question))
+    print(cfg["search_log"].format(question, search_query))
+    cache_put(search_query_cache, cache_key, search_query)
     return search_query
 
 
-def classify_question_type(question: str, history: str, llm) -> str:
+async def classify_question_type(question: str, history: str, llm) -> str:
     """Classifies the question as either a 'follow-up' or a 'new question' based on the conversation history.
     
     Args:
@@ -197,6 +313,16 @@ def classify_question_type(question: str, history: str, llm) -> str:
         str: 'follow-up' or 'new question'.
     
     """
+    # Nothing to follow up on yet, no need to ask the model
+    if not history:
+        return "new question"
+
+    # The answer depends on the conversation so far, so the history is part of the key
+    cache_key = (normalize_question(question), history)
+    cached = cache_get(question_type_cache, cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""
     Given the following conversation history:
     {history}
@@ -208,34 +334,16 @@ def classify_question_type(question: str, history: str, llm) -> str:
 
     Respond with only: 'follow-up' or 'new question'.
     """
-    answer = llm.invoke(prompt).content.strip().lower()
+    answer = (await ainvoke_coalesced(prompt)).lower()
+    cache_put(question_type_cache, cache_key, answer)
     return answer
 
-def clean_response(response: str) -> str:
-    # 1. Remove <think>...</think> blocks
-    response = re.sub(r"<think>.*?</think>", "", response, flags=re.DOTALL)
-
-    # 2. Remove markdown-like bold/italic and hashtags
-    response = re.sub(r"[*_#]+", "", response)
-
-    # 3. Normalize whitespace
-    response = re.sub(r"\s+", " ", response).strip()
-
-    # 4. Optional: fix stray brackets or repeated symbols
-    response = re.sub(r"[{}]+", "", response)
 
-    return response
-
-def rag_answer_with_memory(question: str, user_id: str, top_k: int = 7) -> str:
-    """Generates an answer to the user's question using RAG with memory.
-
-    Args:
-        question (str): The user's question.
-        user_id (str): The unique identifier for the user.
-        top_k (int, optional): Number of top search results in qdrant. Defaults to 7.
+async def prepare_answer(question: str, user_id: str, top_k: int = 7) -> Tuple[LLMChain, Dict[str, str]]:
+    """Runs everything that comes before generation for one user turn.
 
     Returns:
-        str: The generated answer.
+        Tuple[LLMChain, Dict[str, str]]: The user's conversation chain and the prompt inputs to generate from.
     """
     lang = detect_language(question)
     print(f"lang detected : {lang}")
@@ -244,43 +352,100 @@ def rag_answer_with_memory(question: str, user_id: str, top_k: int = 7) -> str:
     if hasattr(conversation.memory, "buffer"):
         history = conversation.memory.buffer
 
-    question_type = classify_question_type(question, history, llm)
+    # The classifier only sees the last turn, its input stays the same size as the chat grows
+    history_tail = get_buffer_string(conversation.memory.chat_memory.messages[-CLASSIFIER_HISTORY_MESSAGES:])
+
+    # Retrieval only needs the rewritten query, so it starts as soon as the rewrite is back
+    # while the follow-up classification may still be running
+    classify_task = asyncio.ensure_future(classify_question_type(question, history_tail, llm))
+    search_query = await get_search_query(question, lang)
+    # The Weaviate client is blocking, keep it off the event loop
+    question_type, rag_context = await asyncio.gather(
+        classify_task,
+        asyncio.to_thread(get_rag_context, search_query, lang, top_k)
+    )
     print(f"🧐 Question classified as: {question_type}")
 
-    search_query = get_search_query(question, lang)
-    rag_context = get_rag_context(search_query, lang, top_k)
-
-    rag_context = date_agent.enhance_context_with_date(rag_context, question)
+    # Most questions are not about dates, skip building the date block for them
+    if date_agent.is_date_related_query(question):
+        rag_context = date_agent.enhance_context_with_date(rag_context, question)
     print(f"📄 RAG Context: {rag_context[:200]}...")
 
     # Conditionally set history for prompt rendering
     injected_history = history if question_type == "follow-up" else ""
+    return conversation, {"input": question, "context": rag_context, "history": injected_history}
+
+
+async def rag_answer_with_memory(question: str, user_id: str, top_k: int = 7) -> str:
+    """Generates an answer to the user's question using RAG with memory.
+
+    Args:
+        question (str): The user's question.
+        user_id (str): The unique identifier for the user.
+        top_k (int, optional): Number of top search results in qdrant. Defaults to 7.
+
+    Returns:
+        str: The generated answer.
+    """
+    conversation, chain_inputs = await prepare_answer(question, user_id, top_k)
 
     try:
-        response = conversation.predict(input=question, context=rag_context, history=injected_history)
+        response = await conversation.apredict(**chain_inputs)
         response_clean = clean_response(response)
 
         return response_clean
     except Exception as e:
         print(f"❌ Error during generation: {e}")
         return "❌ An error occurred. Please try again."
-    
 
 
-def main():
+async def rag_answer_stream(question: str, user_id: str, top_k: int = 7) -> AsyncIterator[str]:
+    """Same as rag_answer_with_memory, but yields the answer as it is generated."""
+    conversation, chain_inputs = await prepare_answer(question, user_id, top_k)
+    response_parts = []
+
+    async def generate() -> AsyncIterator[str]:
+        async for chunk in (conversation.prompt | conversation.llm).astream(chain_inputs):
+            response_parts.append(chunk.content)
+            yield chunk.content
+
+    try:
+        async for text in clean_stream(generate()):
+            yield text
+    except Exception as e:
+        print(f"❌ Error during generation: {e}")
+        yield "❌ An error occurred. Please try again."
+        return
+
+    # The chain is bypassed while streaming, so record the turn here
+    conversation.memory.save_context({"input": question}, {"text": "".join(response_parts)})
+
+
+async def chat_session():
     print(f"{'='*10}This is kai's cli let's begin testing{'='*10}\n\n")
     print("type (exit) or (quit) to terminate the session\n\n")
     status = True
     while status:
-        prompt = input ("user : ")
+        # input() blocks, so it waits on a worker thread and the event loop stays free
+        prompt = await asyncio.to_thread(input, "user : ")
         if "quit" in prompt or "exit" in prompt:
             status = False
         else:
-            answer = rag_answer_with_memory(question= prompt , user_id= '1')
-            print(f"kai's answer : {answer}")
+            # Print the answer as it streams in instead of after the whole completion
+            print("kai's answer : ", end="", flush=True)
+            async for text in rag_answer_stream(question= prompt , user_id= '1'):
+                print(text, end="", flush=True)
+            print()
+    await openai_http_client.aclose()
     print(f"{'='*10}Thank you fo testing Kai, Goodbye!{'='*10}")
 
 
+def main():
+    warmup_retrieval()
+    # One event loop for the whole session, so the async OpenAI client is reused across turns
+    asyncio.run(chat_session())
+
+
 # uncomment this for testing in the cli
 if __name__ == "__main__" :
     main()
\ No newline at end of file
@@ -17,6 +17,14 @@ class DateAgent:
             'هذا الشهر', 'الشهر القادم', 'الشهر الماضي', 'هذا العام', 'العام القادم'
         ]
         
+        # All keywords in one alternation, so a query is scanned once instead of once per keyword.
+        # Latin keywords must be whole words ("now" is not in "know", "date" not in "update");
+        # Arabic ones often carry an attached prefix (واليوم, بالتاريخ), so they match anywhere
+        self.date_keyword_pattern = re.compile("|".join(
+            rf"\b{re.escape(keyword)}\b" if keyword.isascii() else re.escape(keyword)
+            for keyword in self.date_keywords
+        ))
+        
         # Relative date patterns
         self.relative_patterns = {
             'today': 0,
@@ -26,10 +34,24 @@ class DateAgent:
             'غدا': 1,
             'أمس': -1
         }
+        
+        # Keyword -> function of now giving the requested date, in the order keywords take precedence
+        self._relative_date_fns = {
+            pattern: (lambda now, days=days_offset: now + timedelta(days=days))
+            for pattern, days_offset in self.relative_patterns.items()
+        }
+        for pattern in ('next week', 'الأسبوع القادم'):
+            self._relative_date_fns[pattern] = lambda now: now + timedelta(days=7 - now.weekday())
+        for pattern in ('last week', 'الأسبوع الماضي'):
+            self._relative_date_fns[pattern] = lambda now: now - timedelta(days=now.weekday() + 7)
+        # One scan of the query finds every relative keyword in it
+        self._relative_date_pattern = re.compile("|".join(map(re.escape, self._relative_date_fns)))
     
     def is_date_related_query(self, query: str) -> bool:
-        query_lower = query.lower()
-        return any(keyword in query_lower for keyword in self.date_keywords)
+        return self._is_date_related(query.lower())
+    
+    def _is_date_related(self, query_lower: str) -> bool:
+        return self.date_keyword_pattern.search(query_lower) is not None
     
     def get_current_datetime(self) -> Dict[str, Any]:
         now = datetime.now(self.timezone)
@@ -47,40 +69,34 @@ class DateAgent:
         }
     
     def parse_relative_date(self, query: str) -> Optional[datetime]:
-        query_lower = query.lower()
-        now = datetime.now(self.timezone)
-        
-        for pattern, days_offset in self.relative_patterns.items():
-            if pattern in query_lower:
-                target_date = now + timedelta(days=days_offset)
-                return target_date
-        
-        # Handle "next week" / "الأسبوع القادم"
-        if 'next week' in query_lower or 'الأسبوع القادم' in query_lower:
-            days_until_next_week = 7 - now.weekday()
-            return now + timedelta(days=days_until_next_week)
-        
-        # Handle "last week" / "الأسبوع الماضي"
-        if 'last week' in query_lower or 'الأسبوع الماضي' in query_lower:
-            days_to_last_week = now.weekday() + 7
-            return now - timedelta(days=days_to_last_week)
-        
-        return None
+        return self._relative_date(query.lower(), datetime.now(self.timezone))
+    
+    def _relative_date(self, query_lower: str, now: datetime) -> Optional[datetime]:
+        found = set(self._relative_date_pattern.findall(query_lower))
+        if not found:
+            return None
+        # Several keywords in one query resolve the same way as before: the first in table order wins
+        keyword = next(pattern for pattern in self._relative_date_fns if pattern in found)
+        return self._relative_date_fns[keyword](now)
     
     def enhance_context_with_date(self, context: str, query: str) -> str:
-        if not self.is_date_related_query(query):
+        # Lowercased and timestamped once, and only the fields the context shows are formatted
+        query_lower = query.lower()
+        if not self._is_date_related(query_lower):
             return context
         
-        current_info = self.get_current_datetime()
-        relative_date = self.parse_relative_date(query)
+        now = datetime.now(self.timezone)
+        relative_date = self._relative_date(query_lower, now)
         
-        date_context = f"\n\nCURRENT DATE AND TIME INFORMATION:\n"
-        date_context += f"Current Date: {current_info['formatted_date']}\n"
-        date_context += f"Current Time: {current_info['formatted_time']}\n"
-        date_context += f"Timezone: {current_info['timezone']}\n"
+        date_context = (
+            "\n\nCURRENT DATE AND TIME INFORMATION:\n"
+            f"Current Date: {now:%A, %B %d, %Y}\n"
+            f"Current Time: {now:%I:%M %p}\n"
+            f"Timezone: {self.timezone}\n"
+        )
         
         if relative_date:
-            date_context += f"Requested Date: {relative_date.strftime('%A, %B %d, %Y')}\n"
+            date_context += f"Requested Date: {relative_date:%A, %B %d, %Y}\n"
         
         return context + date_context
     
@@ -1,10 +1,14 @@
 import os
+import atexit
+from functools import lru_cache
 from typing import List
 import weaviate
 
 
 DOCUMENT_COLLECTION = os.getenv("WEAVIATE_DOCUMENT_COLLECTION", "Document")
 CHUNK_COLLECTION = os.getenv("WEAVIATE_CHUNK_COLLECTION", "DocChunk")
+# "[filename | title | chunk:N]" traceability prefix followed by the chunk text
+_format_chunk = "[{} | {} | chunk:{}]\n{}".format
 
 
 def create_client():
@@ -33,6 +37,33 @@ def create_client():
         return None
 
 
+def _close_client(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+@lru_cache(maxsize=1)
+def _cached_client():
+    client = create_client()
+    if client:
+        atexit.register(_close_client, client)
+    return client
+
+
+def get_client():
+    """Returns a process-wide Weaviate client, so queries reuse its connection.
+
+    A failed connection is not cached, the next call tries again.
+    """
+    client = _cached_client()
+    if client is None:
+        _cached_client.cache_clear()
+        client = _cached_client()
+    return client
+
+
 def get_rag_context(search_query: str, lang: str = "en", top_k: int = 7) -> str:
     """Query Weaviate for the most relevant chunks and return a combined context string.
 
@@ -44,58 +75,60 @@ def get_rag_context(search_query: str, lang: str = "en", top_k: int = 7) -> str:
     Returns:
         A single string containing concatenated chunk texts (suitable for prompt context).
     """
-    client = create_client()
+    client = get_client()
     if not client:
         return ""  # Empty context on failure
 
+    # v3 query builders are modified in place, so each attempt gets a fresh one
+    def chunk_query():
+        return client.query.get(CHUNK_COLLECTION, ["text", "title", "filename", "chunk_index"]).with_limit(top_k)
+
+    # try hybrid (text+vector) search first
     try:
-        # Prefer hybrid search (text + vector) when available in Weaviate
+        result = chunk_query().with_hybrid({"query": search_query, "alpha": 0.5}).do()
+    except Exception as hybrid_error:
+        print(f"⚠️ Hybrid search failed, falling back to near_text: {hybrid_error}")
+        # fallback to near_text vector search
         try:
-            query_builder = client.query.get(CHUNK_COLLECTION, ["text", "title", "filename", "chunk_index"]).with_limit(top_k)
-            # try hybrid (text+vector) search first
-            try:
-                query = query_builder.with_hybrid({"query": search_query, "alpha": 0.5})
-                result = query.do()
-            except Exception:
-                # fallback to near_text vector search
-                query = query_builder.with_near_text({"concepts": [search_query]})
-                result = query.do()
-        except Exception:
-            # Generic fallback for client variations
-            result = client.query.get(CHUNK_COLLECTION, ["text", "title", "filename", "chunk_index"]).with_near_text({"concepts": [search_query]}).with_limit(top_k).do()
-
-        items = []
-        hits = result.get("data", {}).get("Get", {}).get(CHUNK_COLLECTION, [])
-        for h in hits:
-            # each h expected to be a dict with properties
-            text = h.get("text") or ""
-            title = h.get("title") or ""
-            filename = h.get("filename") or ""
-            chunk_index = h.get("chunk_index")
-            prefix = f"[{filename} | {title} | chunk:{chunk_index}]\n" if filename or title or chunk_index is not None else ""
-            items.append(prefix + text)
-
-        # Concatenate with separators
-        context = "\n\n---\n\n".join(items)
-        return context
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
+            result = chunk_query().with_near_text({"concepts": [search_query]}).do()
+        except Exception as vector_error:
+            print(f"❌ Vector search also failed: {vector_error}")
+            return ""  # Empty context on failure
+
+    parts = []
+    hits = result.get("data", {}).get("Get", {}).get(CHUNK_COLLECTION, [])
+    for h in hits:
+        # each h expected to be a dict with properties
+        text = h.get("text") or ""
+        title = h.get("title") or ""
+        filename = h.get("filename") or ""
+        chunk_index = h.get("chunk_index")
+        if filename or title or chunk_index is not None:
+            parts.append(_format_chunk(filename, title, chunk_index, text))
+        else:
+            parts.append(text)
+
+    # Concatenate with separators
+    return "\n\n---\n\n".join(parts)
+
+
+def warmup():
+    """Connects and runs one small query at startup, so the first user turn
+    does not pay for the connection and for Weaviate paging the index in."""
+    try:
+        get_rag_context("warmup", top_k=1)
+        print("🔥 Retrieval warmed up")
+    except Exception as e:
+        print(f"⚠️ Retrieval warmup failed: {e}")
 
 
 if __name__ == "__main__":
     # simple sanity check
-    c = create_client()
+    c = get_client()
     if c:
         print("Weaviate client ready")
         try:
             print("Available collections (may vary depending on client):")
             print(c.schema.get())
-        except Exception:
-            pass
-        try:
-            c.close()
         except Exception:
             pass
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""
+Answer cleanup
+Strips <think> blocks, markdown markers and extra whitespace from model output,
+either from a whole response or from a stream of pieces as they arrive
+"""
+
+import re
+from typing import AsyncIterator
+
+THINK_PATTERN = re.compile(r"<think>.*?</think>", re.DOTALL)
+# Markdown markers and template braces, deleted in a single str.translate pass
+STRIP_CHARS_TABLE = str.maketrans("", "", "*_#{}")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def clean_response(response: str) -> str:
+    # 1. Remove <think>...</think> blocks
+    response = THINK_PATTERN.sub("", response)
+
+    # 2. Remove markdown-like bold/italic, hashtags and stray brackets
+    response = response.translate(STRIP_CHARS_TABLE)
+
+    # 3. Normalize whitespace
+    return WHITESPACE_PATTERN.sub(" ", response).strip()
+
+
+async def clean_stream(pieces: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Apply clean_response to a stream of text pieces, the joined output equals clean_response of the joined input.
+    <think> blocks are held back until they close, everything else is cleaned and passed on.
+    """
+    pending = ""
+    started = False
+    # Whitespace at the end of the text emitted so far, held back until more text follows,
+    # so a run split across pieces still becomes one space and trailing whitespace is dropped
+    space_pending = False
+
+    def flush(text: str) -> str:
+        nonlocal started, space_pending
+        text = WHITESPACE_PATTERN.sub(" ", text.translate(STRIP_CHARS_TABLE))
+        if text.startswith(" "):
+            space_pending = True
+            text = text[1:]
+        if not text:
+            return ""
+        trailing_space = text.endswith(" ")
+        if trailing_space:
+            text = text[:-1]
+        if space_pending and started:
+            text = " " + text
+        space_pending = trailing_space
+        started = True
+        return text
+
+    async for piece in pieces:
+        pending += piece
+        while True:
+            start = pending.find("<think>")
+            if start == -1:
+                break
+            end = pending.find("</think>", start)
+            if end == -1:
+                break
+            pending = pending[:start] + pending[end + len("</think>"):]
+
+        start = pending.find("<think>")
+        if start == -1:
+            # Hold back a trailing fragment that could still become "<think>"
+            cut = pending.rfind("<")
+            start = cut if cut != -1 and "<think>".startswith(pending[cut:]) else len(pending)
+        text, pending = flush(pending[:start]), pending[start:]
+        if text:
+            yield text
+
+    text = flush(THINK_PATTERN.sub("", pending))
+    if text:
+        yield text